@@ -0,0 +1,76 @@
+# time to first audio with the control reactions awaited before playback versus seeded in the background, leaving out the
+# extraction and ffmpeg start both share, against a local stand-in for the discord api with a fixed round trip and the
+# one reaction per quarter second bucket
+# usage: python -m benchmarks.first_audio [round trip ms] [songs]
+import asyncio, json, statistics, sys, time
+from aiohttp import web
+from discord.http import HTTPClient, Route
+
+CONTROLS = ('\U000023EF', '\U000023ED', '\U0001F500', '\U0001F502')
+USER = {'id': '1', 'username': 'bot', 'discriminator': '0', 'avatar': None, 'global_name': None}
+
+def api(round_trip: float):
+    async def respond(request, body, headers=None):
+        await asyncio.sleep(round_trip)
+        if body is None:
+            return web.Response(status=204, headers=headers)
+        # discord.py only decodes a bare application/json content type
+        return web.Response(body=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+
+    async def get_user(request):
+        return await respond(request, USER)
+
+    async def send_message(request):
+        return await respond(request, {'id': str(time.time_ns()), 'channel_id': request.match_info['channel'], 'content': '',
+            'author': USER, 'embeds': [], 'attachments': [], 'mentions': [], 'mention_roles': [], 'pinned': False,
+            'mention_everyone': False, 'tts': False, 'timestamp': '2020-01-01T00:00:00+00:00', 'edited_timestamp': None, 'type': 0})
+
+    async def add_reaction(request):
+        # the bucket discord uses for reactions, one at a time and a quarter second apart
+        return await respond(request, None, {'X-Ratelimit-Limit': '1', 'X-Ratelimit-Remaining': '0',
+            'X-Ratelimit-Reset-After': '0.25', 'X-Ratelimit-Bucket': 'reactions'})
+
+    app = web.Application()
+    app.router.add_get('/users/@me', get_user)
+    app.router.add_post('/channels/{channel}/messages', send_message)
+    app.router.add_put('/channels/{channel}/messages/{message}/reactions/{emoji}/@me', add_reaction)
+    return app
+
+async def now_playing(http: HTTPClient):
+    message = await http.request(Route('POST', '/channels/{channel_id}/messages', channel_id=1), json={'embeds': []})
+    for emoji in CONTROLS:
+        await http.add_reaction(1, message['id'], emoji)
+
+async def awaited(http: HTTPClient):
+    start = time.perf_counter()
+    await now_playing(http)
+    # voice.play
+    first_audio = time.perf_counter() - start
+    return first_audio, time.perf_counter() - start
+
+async def background(http: HTTPClient):
+    start = time.perf_counter()
+    # voice.play
+    first_audio = time.perf_counter() - start
+    await now_playing(http)
+    return first_audio, time.perf_counter() - start
+
+async def measure(round_trip: float, songs: int):
+    runner = web.AppRunner(api(round_trip))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    Route.BASE = f'http://127.0.0.1:{runner.addresses[0][1]}'
+    http = HTTPClient(asyncio.get_running_loop())
+    await http.static_login('token')
+    for name, play in (('awaited', awaited), ('background', background)):
+        first_audio, controls = zip(*[await play(http) for _ in range(songs)])
+        print(f'{name}: {statistics.median(first_audio) * 1000:.1f}ms median time to first audio ({max(first_audio) * 1000:.1f}ms worst), '
+              f'controls ready after {statistics.median(controls) * 1000:.1f}ms')
+    await http.close()
+    await runner.cleanup()
+
+if __name__ == '__main__':
+    round_trip = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else .08
+    songs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    asyncio.run(measure(round_trip, songs))
@@ -0,0 +1,56 @@
+# memory and time to load a large synthetic guild with every intent versus the profile the cogs ask for
+# usage: python -m benchmarks.guild_memory [members]
+import discord, subprocess, sys, time, tracemalloc
+from discord.ext import commands
+
+from cogs.utils import memory
+
+GUILD, VOICE = 1000, 1001
+
+def guild_payload(count: int, intents: discord.Intents):
+    users = [{'id': str(10**6 + i), 'username': f'user{i}', 'discriminator': '0', 'avatar': None, 'global_name': None} for i in range(count)]
+    # a few members sit in voice, about a fifth are online
+    voice_states = [{'user_id': user['id'], 'channel_id': str(VOICE), 'session_id': 'session', 'deaf': False, 'mute': False,
+                     'self_deaf': False, 'self_mute': False, 'self_video': False, 'suppress': False} for user in users[:25]]
+    # without the members intent discord only sends the members in voice, and presences need their own intent
+    members = users if intents.members else users[:25]
+    return {
+        'id': str(GUILD), 'name': 'Synthetic', 'member_count': count, 'large': True, 'features': [], 'emojis': [], 'stickers': [],
+        'roles': [{'id': str(GUILD), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+        'channels': [{'id': str(VOICE), 'type': 2, 'name': 'voice', 'position': 0, 'permission_overwrites': [], 'bitrate': 64000, 'user_limit': 0}],
+        'voice_states': voice_states,
+        'members': [{'user': user, 'roles': [], 'joined_at': '2020-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0} for user in members],
+        'presences': [{'user': {'id': user['id']}, 'status': 'online', 'activities': [], 'client_status': {'desktop': 'online'}}
+                      for user in users[::5]] if intents.presences else [],
+    }
+
+def measure(profile: str, count: int):
+    if profile == 'all':
+        intents, members, messages = discord.Intents.all(), None, 1000
+    else:
+        from main import DiscordBot
+        intents, members, messages = DiscordBot.profile()
+    bot = commands.Bot(command_prefix='!', intents=intents, member_cache_flags=members, max_messages=messages)
+    payload = guild_payload(count, intents)
+    start = time.perf_counter()
+    bot._connection._add_guild_from_data(payload)
+    elapsed = time.perf_counter() - start
+    # the cache kept for a second copy of the guild, traced separately so tracing does not skew the timing
+    bot._connection.clear()
+    del payload
+    tracemalloc.start()
+    payload = guild_payload(count, intents)
+    guild = bot._connection._add_guild_from_data(payload)
+    del payload
+    retained = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    print(f'{profile}: {len(guild.members)} members cached, {retained:.1f} MiB retained, {elapsed:.2f}s to load, {memory.describe()}')
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if len(sys.argv) > 2:
+        measure(sys.argv[2], count)
+    else:
+        # each profile runs in a fresh process so their resident sets do not mix
+        for profile in ('all', 'cogs'):
+            subprocess.run([sys.executable, '-m', 'benchmarks.guild_memory', str(count), profile], check=True)
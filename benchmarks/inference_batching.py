@@ -0,0 +1,38 @@
+# latency and throughput of the inference worker at different batch windows, under random arrivals of a fixed-cost request
+# usage: python -m benchmarks.inference_batching [requests per second] [milliseconds per request] [requests]
+import asyncio, random, statistics, sys, time
+
+from cogs.translate import InferenceWorker
+
+WINDOWS = (0., .01, .025, .05, .1)
+
+def infer(index: int, cost: float):
+    # stands in for a single forward pass, holding the worker thread for a fixed time
+    time.sleep(cost)
+    return index
+
+async def request(worker: InferenceWorker, index: int, cost: float, latencies: list):
+    start = time.perf_counter()
+    await worker.submit(infer, index, cost)
+    latencies.append(time.perf_counter() - start)
+
+async def measure(window: float, rate: float, cost: float, count: int):
+    worker = InferenceWorker(window, 16)
+    # the same arrival times for every window
+    arrivals, latencies, tasks = random.Random(0), [], []
+    start = time.perf_counter()
+    for index in range(count):
+        await asyncio.sleep(arrivals.expovariate(rate))
+        tasks.append(asyncio.create_task(request(worker, index, cost, latencies)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    worker.task.cancel()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f'window {window * 1000:.0f}ms: p50 {quantiles[49] * 1000:.1f}ms, p99 {quantiles[98] * 1000:.1f}ms, {count / elapsed:.1f} requests per second')
+
+if __name__ == '__main__':
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+    cost = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else .02
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    for window in WINDOWS:
+        asyncio.run(measure(window, rate, cost, count))
@@ -0,0 +1,33 @@
+# CPU per stream of the pcm and opus passthrough playback paths, reading a song as fast as possible
+# usage: python -m benchmarks.opus_passthrough <opus/webm file or url> [repeat]
+import discord, resource, sys
+
+from cogs.music import YTDLSource
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return sum(part.ru_utime + part.ru_stime for part in usage)
+
+def measure(url: str, passthrough: bool, volume: float, repeat: int):
+    YTDLSource.OPUS_PASSTHROUGH = passthrough
+    # the voice player encodes pcm frames itself, so that is part of the cost of the pcm path
+    encoder = discord.opus.Encoder() if not passthrough and discord.opus.is_loaded() else None
+    start, frames = cpu_time(), 0
+    for _ in range(repeat):
+        source = YTDLSource(None, None, {'url': url, 'acodec': 'opus', 'abr': None}, volume=volume)
+        while data := source.read():
+            if encoder:
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+            frames += 1
+        # ffmpeg only counts towards the children once it has been reaped
+        source.cleanup()
+    minutes = frames * discord.opus.Encoder.FRAME_LENGTH / 60000
+    return (cpu_time() - start) / minutes
+
+if __name__ == '__main__':
+    url, repeat = sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    discord.opus._load_default()
+    if not discord.opus.is_loaded():
+        print('libopus not found, the pcm path is measured without the encoding done by the voice player.')
+    for name, passthrough, volume in (('pcm', False, 1.), ('opus copy', True, 1.), ('opus filtered', True, .5)):
+        print(f'{name}: {measure(url, passthrough, volume, repeat):.2f} cpu seconds per minute of audio per stream')
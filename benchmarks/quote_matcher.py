@@ -0,0 +1,64 @@
+# time to match chat messages against quote aliases, tokenizing once per alias as before versus once per message with the alias index
+# usage: python -m benchmarks.quote_matcher [quotes.json] [messages.txt, one message per line]
+import json, random, sys, time
+from collections import defaultdict
+from nltk.tokenize import word_tokenize
+
+WORDS = ('the', 'a', 'is', 'it', 'that', 'i', 'you', 'we', 'lol', 'yeah', 'no', 'what', 'when', 'game', 'tonight', 'play', 'song',
+         'queue', 'why', 'did', 'just', 'so', 'good', 'bad', 'server', 'voice', 'who', 'me', 'ok', 'later', 'now', 'here')
+
+def synthetic(count: int, messages: int):
+    # quote bots with one to three aliases, and short messages where about one in twenty names one of them
+    names = random.Random(0)
+    quotes = {', '.join(f'name{i}x{j}' for j in range(names.randint(1, 3))): ['<@> said so.'] for i in range(count)}
+    aliases = [alias for qbot in quotes for alias in qbot.split(', ')]
+    lines = []
+    for _ in range(messages):
+        words = names.choices(WORDS, k=names.randint(3, 20))
+        if names.random() < .05:
+            words.insert(names.randrange(len(words)), names.choice(aliases).capitalize())
+        lines.append(' '.join(words) + names.choice(('', '.', '?', '!', ' :)')))
+    return quotes, lines
+
+def per_alias(quotes: dict, content: str, tokenize):
+    matches = []
+    for qbot in quotes:
+        for alias in qbot.split(', '):
+            if alias.lower() in tokenize(content.lower()):
+                matches.append(qbot)
+    return matches
+
+def indexed(aliases: dict, order: dict, content: str, tokenize):
+    qbots = {qbot for token in set(tokenize(content.lower())) for qbot in aliases.get(token, ())}
+    return sorted(qbots, key=order.get)
+
+def measure(name: str, match, lines: list):
+    start = time.perf_counter()
+    for content in lines:
+        match(content)
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed / len(lines) * 1e6:.0f}us per message, {len(lines) / elapsed:.0f} messages per second')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        with open(sys.argv[1]) as quotes_file, open(sys.argv[2]) as messages_file:
+            quotes, lines = json.load(quotes_file), [line.strip() for line in messages_file if line.strip()]
+    else:
+        quotes, lines = synthetic(200, 2000)
+    tokenize = word_tokenize
+    try:
+        tokenize('Punkt check.')
+    except LookupError:
+        print('punkt not found, tokenizing without sentence splitting.')
+        tokenize = lambda content: word_tokenize(content, preserve_line=True)
+    # the same index QuoteBot.load_quotes builds
+    aliases = defaultdict(list)
+    for qbot in quotes:
+        for alias in qbot.split(', '):
+            aliases[alias.lower()].append(qbot)
+    order = {qbot: i for i, qbot in enumerate(quotes)}
+    print(f'{len(quotes)} quote bots, {len(aliases)} aliases, {len(lines)} messages')
+    measure('per alias', lambda content: per_alias(quotes, content, tokenize), lines[:200])
+    measure('alias index', lambda content: indexed(aliases, order, content, tokenize), lines)
+    # both report the same quote bots, although the old loop sent a quote once per matching alias
+    assert all(sorted(set(per_alias(quotes, content, tokenize)), key=order.get) == indexed(aliases, order, content, tokenize) for content in lines[:200])
@@ -1,17 +1,54 @@
 from discord import app_commands
 from discord.ext import commands
-import discord, requests, json
+import discord, aiohttp, asyncio, collections
 
 class InsultBot(commands.Cog):
 
+    api_url = 'https://evilinsult.com/generate_insult.php?lang=en&type=json'
+    # http failures, error pages that are not json, and json without an insult
+    ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError)
+    # insults are fetched ahead of time so the command answers from memory
+    BUFFER_SIZE = 10
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.api_url = 'https://evilinsult.com/generate_insult.php?lang=en&type=json'
+        self.insults = collections.deque(maxlen=self.BUFFER_SIZE)
+        self.refill = asyncio.Event()
+        self.task = None
+
+    async def cog_load(self):
+        self.task = self.bot.loop.create_task(self.refill_task())
+
+    def cog_unload(self):
+        if self.task:
+            self.task.cancel()
+
+    async def fetch_insult(self):
+        async with self.bot.session.get(self.api_url) as response:
+            response.raise_for_status()
+            return (await response.json(content_type=None))['insult']
+
+    async def refill_task(self):
+        while True:
+            while len(self.insults) < self.BUFFER_SIZE:
+                try:
+                    self.insults.append(await self.fetch_insult())
+                except self.ERRORS:
+                    await asyncio.sleep(30)
+            self.refill.clear()
+            await self.refill.wait()
 
     @app_commands.command(name='insult', description='Send a random evil insult to someone.')
     async def _insult(self, interaction: discord.Interaction, who: discord.User):
-        response = requests.get(self.api_url)
-        await interaction.response.send_message(f'<@{who.id}> {json.loads(response.text)["insult"]}')
+        self.refill.set()
+        if self.insults:
+            insult = self.insults.popleft()
+        else:
+            try:
+                insult = await self.fetch_insult()
+            except self.ERRORS:
+                return await interaction.response.send_message('Insult Unavailable.')
+        await interaction.response.send_message(f'<@{who.id}> {insult}')
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(InsultBot(bot))
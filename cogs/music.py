@@ -1,17 +1,32 @@
 import asyncio
-import functools
+import bisect
+import collections
+import glob
+import hashlib
+import itertools
 import json
+import os
 import random
 import math
+import shlex
+import subprocess
+import threading
+import time
 
 import discord
 import yt_dlp
 from async_timeout import timeout
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.utils import get
 from ytmusicapi import YTMusic
 
+from cogs.utils.cache import Cache
+from cogs.utils.database import Database
+from cogs.utils import memory
+from cogs.utils.executor import Executor
+from cogs.utils.metrics import Counter, Gauge, Histogram
+
 with open('data/id_dict.json') as id_file:
     id_dict = json.load(id_file)
 
@@ -19,7 +34,135 @@ class VoiceConnectionError(app_commands.AppCommandError): pass
 
 class InvalidVoiceChannel(VoiceConnectionError): pass
 
-class YTDLSource(discord.PCMVolumeTransformer):
+# playback health, served by the server cog at /metrics
+search_seconds = Histogram('music_search_seconds', 'Time to turn a /play search into queue entries, cached or not.')
+extract_seconds = Histogram('music_extract_seconds', 'Time spent in yt_dlp extract_info.')
+ffmpeg_seconds = Histogram('music_ffmpeg_spawn_seconds', 'Time to spawn an ffmpeg process.')
+first_audio_seconds = Histogram('music_first_audio_seconds', 'Time from dequeuing a song to starting playback.')
+first_packet_seconds = Histogram('music_first_packet_seconds', 'Time from dequeuing a song to its first frame reaching the voice player.')
+transition_seconds = Histogram('music_transition_seconds', 'Silence between the end of a song and the start of the next.')
+songs_total = Counter('music_songs_total', 'Songs by how their playback ended up.')
+late_frames_total = Counter('music_late_frames_total', 'Frames the voice player read later than their 20ms slot.')
+player_errors_total = Counter('music_player_errors_total', 'Songs that stopped because the voice player failed.')
+cache_requests_total = Counter('music_cache_requests_total', 'Lookups in the yt_dlp metadata and stream caches.')
+executor_depth = Gauge('music_executor_depth', 'Blocking calls queued or running per executor.')
+executor_coalesced_total = Counter('music_executor_coalesced_total', 'Calls that joined an identical call already in flight.')
+queued_songs = Gauge('music_queued_songs', 'Songs waiting in all guild queues.')
+
+class AudioCache:
+
+    # downloads the audio once and stores it as opus, remuxing when the source already is
+    YTDL_OPTS = {
+        'format': 'bestaudio/best',
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}],
+        'nocheckcertificate': True,
+        'quiet': True,
+        'no_warnings': True,
+        'source_address': '0.0.0.0',
+    }
+
+    def __init__(self, path: str, budget: int, threshold: int):
+        self.path = path
+        self.budget = budget
+        self.threshold = threshold
+        self.plays = collections.Counter()
+        self.pending = set()
+        self.executor = Executor(max_workers=1, name='audio')
+        os.makedirs(os.path.join(path, 'tmp'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'clips'), exist_ok=True)
+
+    def get(self, data: dict):
+        path = os.path.join(self.path, f'{data["id"]}.opus')
+        if data['id'] and os.path.isfile(path):
+            # the modification time doubles as the last access for eviction
+            os.utime(path)
+            return path
+
+    def clip(self, data: dict, ffmpeg: str):
+        if ffmpeg and data['id']:
+            path = self.clip_path(data['id'], ffmpeg)
+            if os.path.isfile(path):
+                return path
+
+    def clip_path(self, video_id: str, ffmpeg: str):
+        # clips are named by the video and the exact -ss/-t range, and are kept out of eviction
+        digest = hashlib.sha1(' '.join(ffmpeg.split()).encode()).hexdigest()[:12]
+        return os.path.join(self.path, 'clips', f'{video_id}.{digest}.opus')
+
+    def hit(self, data: dict):
+        self.plays[data['id']] += 1
+        if self.plays[data['id']] >= self.threshold:
+            self.request(data)
+
+    def request(self, data: dict, ffmpeg: str = None):
+        # songs requested with -ss/-t are rendered as a clip of just that range
+        key = (data['id'], ' '.join(ffmpeg.split())) if ffmpeg else data['id']
+        if self.budget and data['id'] and key not in self.pending and not (self.clip(data, ffmpeg) if ffmpeg else self.get(data)):
+            self.pending.add(key)
+            asyncio.get_running_loop().create_task(self.download(data, ffmpeg, key))
+
+    async def download(self, data: dict, ffmpeg: str, key):
+        try:
+            if ffmpeg:
+                await self.executor.run(self.render, data['id'], data['webpage_url'], ffmpeg)
+            else:
+                await self.executor.run(self.transcode, data['id'], data['webpage_url'])
+        except (yt_dlp.utils.YoutubeDLError, subprocess.SubprocessError, OSError):
+            pass
+        finally:
+            self.pending.discard(key)
+
+    def transcode(self, video_id: str, url: str):
+        tmp = os.path.join(self.path, 'tmp')
+        try:
+            with yt_dlp.YoutubeDL({**self.YTDL_OPTS, 'outtmpl': os.path.join(tmp, '%(id)s.%(ext)s')}) as ytdl:
+                ytdl.extract_info(url, download=True)
+            os.replace(os.path.join(tmp, f'{video_id}.opus'), os.path.join(self.path, f'{video_id}.opus'))
+        except BaseException:
+            # the .part, unconverted and half converted files of the download
+            self.discard_tmp(glob.escape(video_id) + '.*')
+            raise
+        self.evict()
+
+    def render(self, video_id: str, url: str, ffmpeg: str):
+        # cut from the downloaded song when there is one, otherwise from the stream
+        source = os.path.join(self.path, f'{video_id}.opus')
+        if not os.path.isfile(source):
+            with yt_dlp.YoutubeDL({**self.YTDL_OPTS, 'postprocessors': []}) as ytdl:
+                source = ytdl.extract_info(url, download=False)['url']
+        path = self.clip_path(video_id, ffmpeg)
+        tmp = os.path.join(self.path, 'tmp', os.path.basename(path))
+        try:
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', *shlex.split(ffmpeg), '-i', source,
+                            '-vn', '-c:a', 'libopus', '-b:a', '128k', tmp], check=True, timeout=300)
+            os.replace(tmp, path)
+        except BaseException:
+            self.discard_tmp(glob.escape(os.path.basename(tmp)))
+            raise
+
+    def discard_tmp(self, pattern: str):
+        # jobs run one at a time, so whatever a failed job left in tmp is only its own
+        for path in glob.glob(os.path.join(self.path, 'tmp', pattern)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def discard_clip(self, video_id: str, ffmpeg: str):
+        try:
+            os.remove(self.clip_path(video_id, ffmpeg))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        files = [(file.stat().st_mtime, file.stat().st_size, file.path) for file in os.scandir(self.path) if file.is_file()]
+        size = sum(file[1] for file in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.budget: break
+            os.remove(path)
+            size -= file_size
+
+class YTDLSource(discord.AudioSource):
 
     YTDL_OPTS = {
         'format': 'bestaudio/best',
@@ -42,13 +185,93 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'options': '-vn',
     } 
 
+    # opus streams are sent without decoding them to pcm, applying any volume change in ffmpeg;
+    # volume is a plain gain on both paths, so the default of 100% is passed through untouched
+    OPUS_PASSTHROUGH = True
+
     ytdl = yt_dlp.YoutubeDL(YTDL_OPTS)
+    # playlists and searches are listed without resolving each entry
+    ytdl_flat = yt_dlp.YoutubeDL({**YTDL_OPTS, 'extract_flat': 'in_playlist'})
+
+    # stream urls expire long before metadata does, so they are cached separately
+    STREAM_TTL = 3600
+    metadata = Cache('data/ytdl_cache.db', 'metadata', ttl=7 * 24 * 3600, budget=32 * 2**20)
+    streams = Cache('data/ytdl_cache.db', 'streams', ttl=STREAM_TTL, budget=8 * 2**20)
 
-    def __init__(self, source: discord.FFmpegPCMAudio, channel: discord.VoiceChannel, author: discord.User, data: dict):
-        super().__init__(source)
+    # blocking yt_dlp and ytmusicapi calls run here instead of on the event loop
+    executor = Executor(max_workers=4, timeout=30, name='ytdl')
+    # songs played this often, looped or behind a shortcut are kept on disk
+    audio = AudioCache('data/audio', budget=2 * 2**30, threshold=3)
+
+    def __init__(self, channel: discord.VoiceChannel, author: discord.User, data: dict, ffmpeg: str = None, volume: float = 1., offset: float = 0.):
         self.channel = channel
         self.author = author
         self.data = data
+        self.ffmpeg = ffmpeg
+        self.frames = int(offset * 1000 / discord.opus.Encoder.FRAME_LENGTH)
+        self.lock = threading.Lock()
+        self._volume = volume
+        # set by the voice state when the song is dequeued, and the time of the last frame read
+        self.started = None
+        self.last = None
+        self.original = self.create_original(offset)
+
+    def create_original(self, offset: float = 0.):
+        url = self.data['url']
+        FFMPEG_OPTS = self.ffmpeg_opts(url, self.ffmpeg)
+        if offset:
+            # seek on the output side when the song was requested with its own -ss/-t, so that the two add up
+            FFMPEG_OPTS['options' if self.ffmpeg else 'before_options'] += f' -ss {offset:.2f}'
+        with ffmpeg_seconds.time():
+            if not self.OPUS_PASSTHROUGH or self.data.get('acodec') != 'opus':
+                return discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(url, **FFMPEG_OPTS), volume=self._volume)
+            # discord.py stream-copies for codec 'opus' and re-encodes with libopus for anything else
+            if self._volume == 1.:
+                return discord.FFmpegOpusAudio(url, codec='opus', bitrate=self.data.get('abr'), **FFMPEG_OPTS)
+            FFMPEG_OPTS['options'] += f' -af volume={self._volume}'
+            return discord.FFmpegOpusAudio(url, codec=None, **FFMPEG_OPTS)
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        if value == self._volume: return
+        self._volume = value
+        if isinstance(self.original, discord.PCMVolumeTransformer):
+            self.original.volume = value
+            return
+        # restart ffmpeg at the current position with the new gain
+        original = self.create_original(self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000)
+        with self.lock:
+            original, self.original = self.original, original
+        original.cleanup()
+
+    def read(self):
+        now = time.perf_counter()
+        if self.started is not None:
+            first_packet_seconds.observe(now - self.started)
+            self.started = None
+        # gaps of a second or more are pauses rather than a stalled player
+        elif self.last and .04 < now - self.last < 1:
+            late_frames_total.inc()
+        self.last = now
+        with self.lock:
+            self.frames += 1
+            return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def memory(self):
+        # resident memory of the ffmpeg process, discord.py keeps the process on a private attribute
+        original = self.original.original if isinstance(self.original, discord.PCMVolumeTransformer) else self.original
+        process = getattr(original, '_process', None)
+        return (process and memory.rss(process.pid)) or 0.
 
     def create_embed(self):
         duration = self.convert_duration(self.data['duration'])
@@ -60,29 +283,61 @@ class YTDLSource(discord.PCMVolumeTransformer):
                  .set_thumbnail(url=self.data['thumbnail']))
 
     def clone(self):
-        source = discord.FFmpegPCMAudio(self.data['url'], **self.FFMPEG_OPTS)
-        return YTDLSource(source, self.channel, self.author, self.data)
+        url = self.audio.get(self.data)
+        data = {**self.data, 'url': url, 'acodec': 'opus', 'abr': None} if url else self.data
+        return YTDLSource(self.channel, self.author, data, volume=self._volume)
 
     @classmethod
-    async def create_source(cls, interaction: discord.Interaction, search: str, *, loop: asyncio.BaseEventLoop = None, ffmpeg: str = None):
-        loop = loop or asyncio.get_event_loop()
-        # print(json.dumps(ydl.sanitize_info(info)))
-        partial = functools.partial(cls.ytdl.extract_info, url=search, download=False)
-        data = await loop.run_in_executor(None, partial)
-        if 'entries' in data:
-            playlist = asyncio.Queue()
-            for entry in data['entries']:
-                FFMPEG_OPTS = cls.FFMPEG_OPTS.copy()
-                if ffmpeg:
-                    FFMPEG_OPTS['before_options'] += ' ' + ffmpeg
-                source = discord.FFmpegPCMAudio(entry['url'], **FFMPEG_OPTS)
-                await playlist.put(cls(source, interaction.channel, interaction.user, entry))
-            return playlist
-        FFMPEG_OPTS = cls.FFMPEG_OPTS.copy()
+    def ffmpeg_opts(cls, url: str, ffmpeg: str = None):
+        # cached files are local, so the http reconnect options do not apply
+        FFMPEG_OPTS = {'before_options': '', 'options': '-vn'} if os.path.isfile(url) else cls.FFMPEG_OPTS.copy()
         if ffmpeg:
             FFMPEG_OPTS['before_options'] += ' ' + ffmpeg
-        source = discord.FFmpegPCMAudio(data['url'], **FFMPEG_OPTS)
-        return cls(source, interaction.channel, interaction.user, data)
+        return FFMPEG_OPTS
+
+    @classmethod
+    async def create_source(cls, interaction: discord.Interaction, search: str, *, ffmpeg: str = None):
+        key = search.strip() if '://' in search else ' '.join(search.lower().split())
+        with search_seconds.time():
+            entries = await cls.executor.run(cls.extract_entries, key, key=('entries', key))
+        return [YTDLEntry(interaction.channel, interaction.user, entry, ffmpeg) for entry in entries]
+
+    @classmethod
+    def extract_entries(cls, key: str):
+        entries = cls.metadata.get(key)
+        if entries is None:
+            with extract_seconds.time(kind='entries'):
+                data = cls.ytdl_flat.extract_info(key, download=False)
+            entries = [cls.sanitize(entry) for entry in data.get('entries', [data])]
+            cls.metadata.put(key, entries)
+            if 'entries' not in data:
+                cls.streams.put(entries[0]['webpage_url'], {**entries[0], **cls.stream_info(data)})
+        return entries
+
+    @classmethod
+    def extract_stream(cls, webpage_url: str):
+        stream = cls.streams.get(webpage_url)
+        if stream is None:
+            with extract_seconds.time(kind='stream'):
+                data = cls.ytdl.extract_info(webpage_url, download=False)
+            stream = {**cls.sanitize(data), **cls.stream_info(data)}
+            cls.streams.put(webpage_url, stream)
+        return stream
+
+    @staticmethod
+    def sanitize(data: dict):
+        # flat playlist entries only carry a page url and a list of thumbnails
+        return {
+            'id': data.get('id'),
+            'title': data.get('title'),
+            'duration': int(data.get('duration') or 0),
+            'thumbnail': data.get('thumbnail') or (data.get('thumbnails') or [{}])[-1].get('url'),
+            'webpage_url': data.get('webpage_url') or data['url'],
+        }
+
+    @staticmethod
+    def stream_info(data: dict):
+        return {'url': data['url'], 'acodec': data.get('acodec'), 'abr': data.get('abr'), 'resolved': time.time()}
 
     @staticmethod
     def convert_duration(duration: int):
@@ -100,54 +355,239 @@ class YTDLSource(discord.PCMVolumeTransformer):
             duration.append(f'{s} seconds')
         return ', '.join(duration)
 
-class VoiceState(commands.Cog):
+class YTDLEntry:
 
-    def __init__(self, interaction: discord.Interaction):
-        self.bot  = interaction.client
+    def __init__(self, channel: discord.VoiceChannel, author: discord.User, data: dict, ffmpeg: str = None):
+        self.channel = channel
+        self.author = author
+        self.ffmpeg = ffmpeg
+        self.data = dict(data)
+        # position in the queue, and where to start playing when resuming after a restart
+        self.key = None
+        self.offset = 0.
+        self.stream = None
+        self.source = None
+        self.lock = asyncio.Lock()
+
+    async def warm(self, volume: float):
+        # resolve the stream url and spawn ffmpeg so it is buffering before playback
+        async with self.lock:
+            ffmpeg, url = self.ffmpeg, YTDLSource.audio.clip(self.data, self.ffmpeg)
+            if url:
+                # the clip is already cut to the requested range
+                ffmpeg = None
+            else:
+                url = YTDLSource.audio.get(self.data)
+            if url:
+                stream = {'url': url, 'acodec': 'opus', 'abr': None}
+            else:
+                if self.stream is None or time.time() - self.stream['resolved'] > YTDLSource.STREAM_TTL:
+                    webpage_url = self.data['webpage_url']
+                    data = await YTDLSource.executor.run(YTDLSource.extract_stream, webpage_url, key=('stream', webpage_url))
+                    for key, value in self.data.items():
+                        if not value: self.data[key] = data.get(key)
+                    self.stream = {key: data.get(key) for key in ('url', 'acodec', 'abr', 'resolved')}
+                stream = self.stream
+            if self.source and self.source.data['url'] != stream['url']:
+                self.cleanup()
+            if self.source is None:
+                self.source = YTDLSource(self.channel, self.author, {**self.data, **stream}, ffmpeg, volume, self.offset)
+            return self.source
+
+    def cleanup(self):
+        if self.source:
+            self.source.cleanup()
+            self.source = None
+
+class SongQueue:
+
+    # songs are kept sorted by (round, order) in blocks of bounded size, so that
+    # appending, popping, indexing and removing never touch more than a block or two
+    BLOCK_SIZE = 256
+
+    def __init__(self, fair: bool = True):
+        self.fair = fair
+        self.blocks = []
+        self.maxes = []
+        self.size = 0
+        self.duration = 0
+        # with fairness, each user's n-th pending song plays in round n
+        self.round = 0
+        self.rounds = {}
+        self.count = 0
+        self.event = asyncio.Event()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for block in self.blocks:
+            for _, _, entry in block:
+                yield entry
+
+    def __getitem__(self, index: int):
+        i, j = self.locate(index)
+        return self.blocks[i][j][2]
+
+    def __delitem__(self, index: int):
+        i, j = self.locate(index)
+        self.pop(i, j)
+
+    def empty(self):
+        return self.size == 0
+
+    def locate(self, index: int):
+        if not 0 <= index < self.size:
+            raise IndexError('queue index out of range')
+        for i, block in enumerate(self.blocks):
+            if index < len(block):
+                return i, index
+            index -= len(block)
+
+    def put(self, entry: 'YTDLEntry', key: tuple = None):
+        # songs restored after a restart keep the key they were queued with
+        if key is None:
+            if self.fair:
+                key = (max(self.round, self.rounds.get(entry.author.id, -1) + 1), self.count)
+            else:
+                key = (self.round, self.count)
+        self.rounds[entry.author.id] = max(self.rounds.get(entry.author.id, -1), key[0])
+        self.count = max(self.count, key[1]) + 1
+        entry.key = key
+        item = (key, entry.data['duration'], entry)
+        i = min(bisect.bisect_left(self.maxes, item[0]), len(self.blocks) - 1)
+        if i < 0:
+            self.blocks.append([item])
+            self.maxes.append(item[0])
+        else:
+            bisect.insort(self.blocks[i], item)
+            self.maxes[i] = self.blocks[i][-1][0]
+            if len(self.blocks[i]) > 2 * self.BLOCK_SIZE:
+                block = self.blocks[i]
+                self.blocks[i:i + 1] = [block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]]
+                self.maxes[i:i + 1] = [block[self.BLOCK_SIZE - 1][0], block[-1][0]]
+        self.size += 1
+        self.duration += item[1]
+        self.event.set()
+
+    def pop(self, i: int = 0, j: int = 0):
+        item = self.blocks[i].pop(j)
+        if not self.blocks[i]:
+            del self.blocks[i], self.maxes[i]
+        else:
+            self.maxes[i] = self.blocks[i][-1][0]
+        self.size -= 1
+        self.duration -= item[1]
+        return item
+
+    async def get(self):
+        while not self.size:
+            self.event.clear()
+            await self.event.wait()
+        (self.round, _), _, entry = self.pop()
+        return entry
+
+    def page(self, start: int, stop: int):
+        songs = []
+        for block in self.blocks:
+            if start < len(block):
+                songs += [entry for _, _, entry in block[start:stop]]
+                if stop <= len(block): break
+            start, stop = max(start - len(block), 0), stop - len(block)
+        return songs
+
+    def shuffle(self):
+        entries = list(self)
+        random.shuffle(entries)
+        self.clear()
+        self.fair, fair = False, self.fair
+        for entry in entries:
+            self.put(entry)
+        self.fair = fair
+
+    def clear(self):
+        self.blocks.clear()
+        self.maxes.clear()
+        self.size = 0
+        self.duration = 0
+        self.rounds.clear()
+
+class VoiceState:
+
+    # number of upcoming songs kept resolved and buffering while the current song plays,
+    # and the memory in MiB their ffmpeg processes may use between them
+    PREFETCH_DEPTH = 2
+    PREFETCH_MEMORY = 64
+
+    def __init__(self, cog: 'MusicBot', guild: discord.Guild):
+        self.cog   = cog
+        self.bot   = cog.bot
+        self.guild = guild
 
         self.voice = None
         self.next  = asyncio.Event()
-        self.queue = asyncio.Queue()
+        self.queue = SongQueue()
 
         self.loop    = False
-        self.volume  = .5
-        self.active  = True
+        self.volume  = 1.
         self.current = None
         self.message = None
+        self.ended   = None
+        self.warmed  = set()
+        self.prefetching = None
 
-        self.bot.loop.create_task(self.audio_task())
-
-    def reactivate(self):
-        self.active = True
-        self.bot.loop.create_task(self.audio_task())
+        self.task = self.bot.loop.create_task(self.audio_task())
 
     async def audio_task(self):
         while True:
             self.next.clear()
             try:
                 async with timeout(300):
-                    self.current = await self.queue.get()
-                    await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=self.current.data['title']))
+                    entry = await self.queue.get()
             except asyncio.TimeoutError:
                 return self.bot.loop.create_task(self.stop())
 
-            self.message = await self.current.channel.send(embed=self.current.create_embed())
-            for emoji in ('\U000023EF', '\U000023ED', '\U0001F500', '\U0001F502'):
-                await self.message.add_reaction(emoji)
+            start = time.perf_counter()
+            self.warmed.discard(entry)
+            try:
+                self.current = await entry.warm(self.volume)
+            except (yt_dlp.utils.DownloadError, asyncio.TimeoutError):
+                songs_total.inc(result='unavailable')
+                await self.delete_songs([entry.key])
+                await entry.channel.send('Song Unavailable.')
+                continue
+            YTDLSource.audio.hit(entry.data)
+
+            # start playback first, the now playing message and its controls follow
             self.current.volume = self.volume
+            self.current.started = start
             self.voice.play(self.current, after=self.next_song)
+            songs_total.inc(result='played')
+            first_audio_seconds.observe(time.perf_counter() - start)
+            if self.ended is not None:
+                transition_seconds.observe(time.perf_counter() - self.ended)
+                self.ended = None
+            await self.save()
+            self.bot.dispatch('track_change', self.guild, self.current.data)
+            await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=self.current.data['title']))
+
+            self.message = await self.current.channel.send(embed=self.current.create_embed())
+            self.bot.reactions.register(self.message.id, self)
+            seeding = self.bot.reactions.seed(self.message, ('\U000023EF', '\U000023ED', '\U0001F500', '\U0001F502'))
+            self.start_prefetch()
 
             await self.next.wait()
+            await self.delete_songs([entry.key])
+            seeding.cancel()
+            self.bot.dispatch('track_change', self.guild, None)
             await self.bot.change_presence(activity=None)
+            self.bot.reactions.unregister(self.message.id)
             await self.message.clear_reactions()
             # try: await self.message.delete()
             # except discord.HTTPException: pass
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+    async def on_reaction_add(self, payload: discord.RawReactionActionEvent):
         if payload.user_id != id_dict['bot']:
-            channel = await self.bot.fetch_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
             if str(payload.emoji) == '\U000023EF':
                 if not self.voice.is_paused():
                     self.voice.pause()
@@ -169,15 +609,19 @@ class VoiceState(commands.Cog):
             #         await self.message.clear_reactions()
             elif str(payload.emoji) == '\U0001F500':
                 if not self.queue.empty():
-                    random.shuffle(self.queue._queue)
-                await message.remove_reaction(payload.emoji, payload.member)
+                    stale = [entry.key for entry in self.queue]
+                    self.queue.shuffle()
+                    self.start_prefetch()
+                    await self.delete_songs(stale)
+                    await self.save_songs(self.queue)
+                await self.message.remove_reaction(payload.emoji, payload.member)
             elif str(payload.emoji) == '\U0001F502':
                 self.loop = True
+                YTDLSource.audio.request(self.current.data)
+                await self.save()
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
-        channel = await self.bot.fetch_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
+    async def on_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        message = await self.bot.reactions.fetch_message(payload)
         if str(payload.emoji) == '\U000023EF':
             reaction = get(message.reactions, emoji=payload.emoji.name)
             if reaction.count < 2:
@@ -186,39 +630,183 @@ class VoiceState(commands.Cog):
             reaction = get(message.reactions, emoji=payload.emoji.name)
             if reaction.count < 2:
                 self.loop = False
+                await self.save()
+
+    def start_prefetch(self):
+        # one look-ahead runs at a time, so a newer window replaces the one still being warmed
+        if self.prefetching:
+            self.prefetching.cancel()
+        self.prefetching = self.bot.loop.create_task(self.prefetch())
+
+    async def prefetch(self):
+        upcoming = list(itertools.islice(self.queue, self.PREFETCH_DEPTH))
+        # release ffmpeg processes of songs that were moved out of the look-ahead window
+        for entry in self.warmed - set(upcoming):
+            entry.cleanup()
+        self.warmed = set(upcoming)
+        for entry in upcoming:
+            # the nearest songs are warmed first, the rest wait until they are dequeued once the cap is reached
+            if sum(warmed.source.memory() for warmed in self.warmed if warmed.source) > self.PREFETCH_MEMORY:
+                entry.cleanup()
+                self.warmed.discard(entry)
+                continue
+            try:
+                await entry.warm(self.volume)
+            except (yt_dlp.utils.DownloadError, asyncio.TimeoutError):
+                pass
 
     def next_song(self, error=None):
-        if error: raise VoiceConnectionError(str(error))
+        if error:
+            player_errors_total.inc()
+            raise VoiceConnectionError(str(error))
         if self.loop:
+            songs_total.inc(result='looped')
             # https://github.com/Rapptz/discord.py/issues/4003
             self.current = self.current.clone()
             self.current.volume = self.volume
             self.voice.play(self.current, after=self.next_song)
-        else: self.next.set()
+        else:
+            self.ended = time.perf_counter()
+            self.next.set()
 
     def playing(self):
         return self.voice and self.current
 
+    def position(self):
+        if self.voice and (self.voice.is_playing() or self.voice.is_paused()):
+            return self.current.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+        return 0.
+
+    async def save(self):
+        # the songs themselves are saved as they are queued, this covers the rest of the playback state
+        await self.cog.database.execute('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?, ?)',
+            (self.guild.id, self.voice.channel.id, self.loop, self.volume, self.position()))
+
+    async def save_songs(self, entries):
+        await self.cog.database.executemany('INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(self.guild.id, *entry.key, entry.channel.id, entry.author.id, json.dumps(entry.data), entry.ffmpeg) for entry in entries])
+
+    async def delete_songs(self, keys):
+        await self.cog.database.executemany('DELETE FROM songs WHERE guild = ? AND seq = ?',
+            [(self.guild.id, seq) for _, seq in keys])
+
     def skip(self):
         if self.playing():
             self.voice.stop()
 
     async def stop(self):
-        self.queue._queue.clear()
+        if self.prefetching:
+            self.prefetching.cancel()
+        for entry in self.warmed:
+            entry.cleanup()
+        self.warmed.clear()
+        self.queue.clear()
+        self.cog.voice_states.pop(self.guild.id, None)
+        await self.cog.forget(self.guild.id)
+        if self.message:
+            self.bot.reactions.unregister(self.message.id)
+        self.bot.dispatch('track_change', self.guild, None)
         await self.bot.change_presence(activity=None)
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
-            self.active = False
+        self.task.cancel()
 
 class MusicBot(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.ytmusic = YTMusic()
-        self.voice_state = None
-        with open('data/shortcuts.json') as shortcut_file:
-            self.shortcuts = json.load(shortcut_file)
+        # guild id -> VoiceState
+        self.voice_states = {}
+        self.shortcuts = {}
+        # queues are snapshotted here as they change, so they survive restarts
+        self.database = Database('data/music.db')
+        queued_songs.track(lambda: sum(len(voice_state.queue) for voice_state in self.voice_states.values()))
+        for cache in (YTDLSource.metadata, YTDLSource.streams):
+            cache_requests_total.track(lambda cache=cache: cache.hits, cache=cache.table, result='hit')
+            cache_requests_total.track(lambda cache=cache: cache.misses, cache=cache.table, result='miss')
+        for name, executor in (('ytdl', YTDLSource.executor), ('audio', YTDLSource.audio.executor)):
+            executor_depth.track(lambda executor=executor: executor.depth, executor=name)
+            executor_coalesced_total.track(lambda executor=executor: executor.coalesced, executor=name)
+
+    async def cog_load(self):
+        await self.database.executescript('''
+            CREATE TABLE IF NOT EXISTS guilds (guild INTEGER PRIMARY KEY, voice INTEGER, loop INTEGER, volume REAL, position REAL);
+            CREATE TABLE IF NOT EXISTS songs (guild INTEGER, round INTEGER, seq INTEGER, channel INTEGER, author INTEGER, data TEXT, ffmpeg TEXT, PRIMARY KEY (guild, seq));
+            CREATE TABLE IF NOT EXISTS shortcuts (name TEXT PRIMARY KEY, search TEXT, ffmpeg TEXT, id TEXT);
+        ''')
+        if os.path.exists('data/shortcuts.json'):
+            # one-time import of shortcuts saved before the database existed
+            with open('data/shortcuts.json') as shortcut_file:
+                shortcuts = json.load(shortcut_file)
+            await self.database.executemany('INSERT OR REPLACE INTO shortcuts VALUES (?, ?, ?, NULL)',
+                [(name, shortcut['search'], shortcut['ffmpeg']) for name, shortcut in shortcuts.items()])
+            os.replace('data/shortcuts.json', 'data/shortcuts.json.bak')
+        for name, search, ffmpeg, video_id in await self.database.fetch('SELECT * FROM shortcuts'):
+            self.shortcuts[name] = {'search': search, 'ffmpeg': ffmpeg, 'id': video_id}
+        self.snapshot_task.start()
+        self.bot.loop.create_task(self.restore())
+
+    def cog_unload(self):
+        self.snapshot_task.cancel()
+
+    @tasks.loop(seconds=10)
+    async def snapshot_task(self):
+        for voice_state in list(self.voice_states.values()):
+            if voice_state.voice and voice_state.voice.is_playing():
+                await voice_state.save()
+
+    async def restore(self):
+        # reconnect and resume where playback stopped, stream urls are resolved again as each song comes up
+        await self.bot.wait_until_ready()
+        for guild_id, voice_id, loop, volume, position in await self.database.fetch('SELECT * FROM guilds'):
+            guild = self.bot.get_guild(guild_id)
+            channel = guild and guild.get_channel(voice_id)
+            rows = await self.database.fetch('SELECT * FROM songs WHERE guild = ? ORDER BY round, seq', (guild_id,))
+            if not rows or channel is None or all(member.bot for member in channel.members):
+                await self.forget(guild_id)
+                continue
+            voice_state = self.voice_states[guild_id] = VoiceState(self, guild)
+            voice_state.loop, voice_state.volume = bool(loop), volume
+            try:
+                voice_state.voice = await channel.connect()
+                restored = await self.restore_songs(voice_state, rows, position)
+            except (discord.DiscordException, asyncio.TimeoutError, OSError):
+                # one guild failing to come back does not hold up the others
+                await voice_state.stop()
+                continue
+            print(f'Restored {restored} Songs ({guild.name}).')
+
+    async def restore_songs(self, voice_state: VoiceState, rows: list, position: float):
+        guild, authors = voice_state.guild, {}
+        # songs whose text channel is gone report to another song's channel instead
+        channels = [self.bot.get_channel(channel_id) for _, _, _, channel_id, _, _, _ in rows]
+        fallback = next((channel for channel in channels if channel), guild.system_channel)
+        restored, skipped = 0, []
+        for text_channel, (_, song_round, seq, _, author_id, data, ffmpeg) in zip(channels, rows):
+            text_channel = text_channel or fallback
+            # requesters outside of voice are not cached, so each one is fetched at most once
+            if author_id not in authors:
+                try:
+                    authors[author_id] = guild.get_member(author_id) or self.bot.get_user(author_id) or await self.bot.fetch_user(author_id)
+                except discord.NotFound:
+                    authors[author_id] = None
+            if text_channel is None or authors[author_id] is None:
+                skipped.append((song_round, seq))
+                continue
+            entry = YTDLEntry(text_channel, authors[author_id], json.loads(data), ffmpeg)
+            # the saved position belongs to the song that was playing, the first one restored
+            if restored == 0:
+                entry.offset = position
+            voice_state.queue.put(entry, (song_round, seq))
+            restored += 1
+        await voice_state.delete_songs(skipped)
+        return restored
+
+    async def forget(self, guild_id: int):
+        await self.database.execute('DELETE FROM guilds WHERE guild = ?', (guild_id,))
+        await self.database.execute('DELETE FROM songs WHERE guild = ?', (guild_id,))
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -229,22 +817,27 @@ class MusicBot(commands.Cog):
     async def _play(self, interaction: discord.Interaction, search: str, music: bool = False,
                     timestamp: str = None, duration: str = None, volume: int = None, shortcut: str = None):
         await interaction.response.defer()
-        await self.ensure_voice_state(interaction)
-        voice_state = self.voice_state
+        voice_state = await self.ensure_voice_state(interaction)
         if not voice_state.voice:
             channel = interaction.user.voice.channel
             voice_state.voice = await channel.connect()
-            voice_state.volume = 0.5
+            voice_state.volume = 1.
 
         ffmpeg = ''
+        # only the range a shortcut is stored with gets a clip, one-off ranges are not kept
+        clip = None
+        hot = search in self.shortcuts or shortcut is not None
         if search in self.shortcuts:
             database = self.shortcuts[search]
             search = database['search']
             if timestamp is None and duration is None:
-                ffmpeg = database['ffmpeg']
+                ffmpeg = clip = database['ffmpeg']
         if music:
-            search = 'https://music.youtube.com/watch?v=' \
-                + self.ytmusic.search(search, filter='songs')[0]['videoId']
+            try:
+                results = await YTDLSource.executor.run(self.ytmusic.search, search, filter='songs', key=('ytmusic', search))
+            except asyncio.TimeoutError:
+                return await interaction.followup.send('Search Timed Out.')
+            search = 'https://music.youtube.com/watch?v=' + results[0]['videoId']
         if timestamp:
             ffmpeg += '-ss ' + timestamp + ' '
         if duration:
@@ -252,95 +845,114 @@ class MusicBot(commands.Cog):
         if volume:
             if volume <= 0 or volume > 200:
                 return await interaction.response.send_message(f'Invalid Volume.')
-            voice_state.volume = 0.5 * (volume / 100)
+            voice_state.volume = volume / 100
 
-        source = await YTDLSource.create_source(interaction, search, loop=self.bot.loop, ffmpeg=ffmpeg)
+        try:
+            entries = await YTDLSource.create_source(interaction, search, ffmpeg=ffmpeg)
+        except asyncio.TimeoutError:
+            return await interaction.followup.send('Search Timed Out.')
         if duration:
-            source.data['duration'] = int(duration)
+            for entry in entries:
+                entry.data['duration'] = int(duration)
         if shortcut:
-            self.shortcuts[shortcut] = {'search': search, 'ffmpeg': ffmpeg}
-            with open('data/shortcuts.json', 'w') as shortcut_file:
-                json.dump(self.shortcuts, shortcut_file, indent=4)
-        if isinstance(source, asyncio.Queue):
-            queue_size = 0
-            while not source.empty():
-                await voice_state.queue.put(source.get_nowait())
-                queue_size += 1
-            await interaction.followup.send('Playlist Enqueued.' if queue_size > 1 else 'Song Enqueued.')
-        else:
-            await voice_state.queue.put(source)
-            await interaction.followup.send('Song Enqueued.')
+            old = self.shortcuts.get(shortcut)
+            video_id = entries[0].data['id'] if len(entries) == 1 else None
+            self.shortcuts[shortcut] = {'search': search, 'ffmpeg': ffmpeg, 'id': video_id}
+            clip = ffmpeg
+            await self.database.execute('INSERT OR REPLACE INTO shortcuts VALUES (?, ?, ?, ?)', (shortcut, search, ffmpeg, video_id))
+            # a redefined shortcut drops its clip unless another shortcut still plays it
+            if old and old['id'] and old['ffmpeg'] and (old['id'], old['ffmpeg']) not in {(other['id'], other['ffmpeg']) for other in self.shortcuts.values()}:
+                YTDLSource.audio.discard_clip(old['id'], old['ffmpeg'])
+        if hot and len(entries) == 1:
+            YTDLSource.audio.request(entries[0].data, clip)
+        for entry in entries:
+            voice_state.queue.put(entry)
+        await voice_state.save_songs(entries)
+        await voice_state.save()
+        await interaction.followup.send('Playlist Enqueued.' if len(entries) > 1 else 'Song Enqueued.')
+        if voice_state.playing():
+            voice_state.start_prefetch()
 
     @app_commands.command(name='queue', description='Show the current queue of songs or videos.')
     async def _queue(self, interaction: discord.Interaction, page: int = 1):
-        voice_state = self.voice_state
+        voice_state = self.voice_states.get(interaction.guild.id)
         await self.ensure_connection(voice_state)
         if voice_state.queue.empty() and not voice_state.playing():
             return await interaction.response.send_message('Queue Empty.')
 
-        queue_list = [voice_state.current] + list(voice_state.queue._queue)
-        page_count = math.ceil(len(queue_list) / 5)
+        queue_size = len(voice_state.queue) + 1
+        page_count = math.ceil(queue_size / 5)
         start = (page - 1) * 5
+        # the current song is position 1, followed by the queue
+        songs = voice_state.queue.page(max(start - 1, 0), start + 4)
+        if start == 0:
+            songs = [voice_state.current] + songs
 
         description = ''
-        for i, song in enumerate(queue_list[start:(start + 5)], start=start):
+        for i, song in enumerate(songs, start=start):
             description += f'`{i + 1}.` **{song.data["title"]}**\n'
-        embed = discord.Embed(title=f'Queue ({len(queue_list)})', description=description,
-            color=discord.Color.red()).set_footer(text=f'Page {page} of {page_count}')
+        duration = YTDLSource.convert_duration(voice_state.queue.duration)
+        embed = discord.Embed(title=f'Queue ({queue_size})', description=description,
+            color=discord.Color.red()).set_footer(text=f'Page {page} of {page_count}' + (f' \u2022 {duration}' if duration else ''))
         await interaction.response.send_message(embed=embed)
 
     @app_commands.command(name='volume', description='Set the volume of the current song or video.')
     async def _volume(self, interaction: discord.Interaction, value: int = None):
-        voice_state = self.voice_state
+        voice_state = self.voice_states.get(interaction.guild.id)
         await self.ensure_connection(voice_state)
         if not voice_state.playing():
             return await interaction.response.send_message('Nothing Playing.')
         if value is None:
-            # return await interaction.response.send_message(f'Current Volume ({int(voice_state.volume * 200)}%).')
-            embed = discord.Embed(title='Volume', description=f'\U0001F509 {int(voice_state.volume * 200)}%', color=discord.Color.orange())
+            # return await interaction.response.send_message(f'Current Volume ({round(voice_state.volume * 100)}%).')
+            embed = discord.Embed(title='Volume', description=f'\U0001F509 {round(voice_state.volume * 100)}%', color=discord.Color.orange())
             return await interaction.response.send_message(embed=embed)
         if value <= 0 or value > 200:
             return await interaction.response.send_message(f'Invalid Volume.')
 
         old_value = voice_state.current.volume
-        voice_state.current.volume = 0.5 * (value / 100)
+        voice_state.current.volume = value / 100
         voice_state.volume = voice_state.current.volume
+        await voice_state.save()
 
         # await interaction.response.send_message(f'Volume Changed ({value}%).')
-        embed = discord.Embed(title='Volume', description=f'\U0001F509 {int(old_value * 200)}% \U00002192 {int(voice_state.volume * 200)}%', color=discord.Color.orange())
+        embed = discord.Embed(title='Volume', description=f'\U0001F509 {round(old_value * 100)}% \U00002192 {round(voice_state.volume * 100)}%', color=discord.Color.orange())
         await interaction.response.send_message(embed=embed)
 
     @app_commands.command(name='remove', description='Remove a song or video from the queue.')
     async def _remove(self, interaction: discord.Interaction, index: int):
-        voice_state = self.voice_state
+        voice_state = self.voice_states.get(interaction.guild.id)
         await self.ensure_connection(voice_state)
         if voice_state.queue.empty() and not voice_state.playing():
             return await interaction.response.send_message('Empty Queue.')
 
-        queue = voice_state.queue._queue
+        queue = voice_state.queue
         if index == 1 and interaction.user == voice_state.current.author:
             voice_state.skip()
             await interaction.response.send_message('Song Removed.')
         elif interaction.user == queue[index - 2].author:
+            entry = queue[index - 2]
+            entry.cleanup()
             del queue[index - 2]
+            await voice_state.delete_songs([entry.key])
             await interaction.response.send_message('Song Removed.')
         else:
             await interaction.response.send_message('Illegal Dequeue.')
 
     @app_commands.command(name='move', description='Move from one voice channel to another.')
     async def _move(self, interaction: discord.Interaction, channel: discord.VoiceChannel = None):
-        voice_state = self.voice_state
+        voice_state = self.voice_states.get(interaction.guild.id)
         await self.ensure_connection(voice_state)
         channel = channel or interaction.user.voice.channel
         if voice_state.voice:
             await voice_state.voice.move_to(channel)
         else:
             voice_state.voice = await channel.connect()
+        await voice_state.save()
         await interaction.response.send_message(f'Connected to <#{channel.id}>.')
 
     @app_commands.command(name='leave', description='Clear the queue and leave the channel.')
     async def _leave(self, interaction: discord.Interaction):
-        voice_state = self.voice_state
+        voice_state = self.voice_states.get(interaction.guild.id)
         await self.ensure_connection(voice_state)
         channel = interaction.user.voice.channel
         await voice_state.stop()
@@ -349,20 +961,19 @@ class MusicBot(commands.Cog):
         await interaction.response.send_message(f'Disconnected from <#{channel.id}>.')
 
     async def ensure_connection(self, voice_state: VoiceState):
-        if not voice_state.voice:
+        if not voice_state or not voice_state.voice:
             raise app_commands.AppCommandError(f'{self.bot.user.name} not connected to a voice channel.')
 
     async def ensure_voice_state(self, interaction: discord.Interaction):
-        if not self.voice_state: # or not self.voice_state.active:
-            self.voice_state = VoiceState(interaction)
-            await self.bot.add_cog(self.voice_state)
-        if not self.voice_state.active:
-            self.voice_state.reactivate()
         if not interaction.user.voice or not interaction.user.voice.channel:
             raise app_commands.AppCommandError(f'{interaction.user.name} isn\'t connected to a voice channel.')
-        if self.voice_state.voice:
-            if self.voice_state.voice.channel != interaction.user.voice.channel:
+        voice_state = self.voice_states.get(interaction.guild.id)
+        if not voice_state:
+            voice_state = self.voice_states[interaction.guild.id] = VoiceState(self, interaction.guild)
+        if voice_state.voice:
+            if voice_state.voice.channel != interaction.user.voice.channel:
                 raise app_commands.AppCommandError(f'{self.bot.user.name} already connected to a voice channel.')
+        return voice_state
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(MusicBot(bot))
@@ -6,21 +6,16 @@ class PinBot(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.bot.reactions.subscribe('\U0001F4CC', self)
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload):
-        if str(payload.emoji) == '\U0001F4CC':
-            channel = await self.bot.fetch_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            await message.pin()
+    async def on_reaction_add(self, payload):
+        message = await self.bot.reactions.fetch_message(payload)
+        await message.pin()
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_remove(self, payload):
-        if str(payload.emoji) == '\U0001F4CC':
-            channel = await self.bot.fetch_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            if not '\U0001F4CC' in (reaction.emoji for reaction in message.reactions):
-                await message.unpin()
+    async def on_reaction_remove(self, payload):
+        message = await self.bot.reactions.fetch_message(payload)
+        if not '\U0001F4CC' in (reaction.emoji for reaction in message.reactions):
+            await message.unpin()
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(PinBot(bot))
@@ -1,10 +1,43 @@
+from collections import Counter
 from discord import app_commands
 from discord.ext import commands
 import discord, json
 
+from cogs.utils.database import Database
+
 with open('data/id_dict.json') as id_file:
     id_dict = json.load(id_file)
 
+class Poll:
+
+    def __init__(self, channel_id: int, author_id: int, title: str, options: list, multiple_choice: bool, closed: bool = False):
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.title = title
+        self.options = options
+        self.multiple_choice = multiple_choice
+        self.closed = closed
+        # user id -> chosen emojis, and emoji -> number of votes
+        self.votes = {}
+        self.counts = Counter()
+
+    def vote(self, user_id: int, emoji: str):
+        # repeated add events for the same reaction count once
+        if emoji in self.votes.get(user_id, ()):
+            return False
+        self.votes.setdefault(user_id, set()).add(emoji)
+        self.counts[emoji] += 1
+        return True
+
+    def unvote(self, user_id: int, emoji: str):
+        if emoji not in self.votes.get(user_id, ()):
+            return False
+        self.votes[user_id].discard(emoji)
+        if not self.votes[user_id]:
+            del self.votes[user_id]
+        self.counts[emoji] -= 1
+        return True
+
 class PollBot(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
@@ -12,43 +45,83 @@ class PollBot(commands.Cog):
         self.emojis = ['\u0031\uFE0F\u20E3', '\u0032\uFE0F\u20E3', '\u0033\uFE0F\u20E3', '\u0034\uFE0F\u20E3',
                        '\u0035\uFE0F\u20E3', '\u0036\uFE0F\u20E3', '\u0037\uFE0F\u20E3', '\u0038\uFE0F\u20E3',
                        '\u0039\uFE0F\u20E3', '\U0001F51F']
+        self.polls = {}
+        self.database = Database('data/polls.db')
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        channel = await self.bot.fetch_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        if message.author.id == id_dict['bot'] != payload.member.id:
-            # only allow poll-specific reactions
-            if ('[Poll]' in message.content or '[Multi-Poll]' in message.content) \
-                and payload.emoji.name not in self.emojis + ['\u2705', '\u274E']:
-                    await message.clear_reaction(payload.emoji)
-            # only allow one reaction per user if not multiple-choice
-            if '[Poll]' in message.content:
-                for reaction in message.reactions:
-                    if reaction.emoji == payload.emoji.name: continue
-                    users = [user async for user in reaction.users()]
-                    if any(payload.user_id == user.id for user in users):
-                        return await message.remove_reaction(payload.emoji, payload.member)
+    async def cog_load(self):
+        await self.database.executescript('''
+            CREATE TABLE IF NOT EXISTS polls (id INTEGER PRIMARY KEY, channel INTEGER, author INTEGER, title TEXT, options TEXT, multiple INTEGER, closed INTEGER);
+            CREATE TABLE IF NOT EXISTS votes (poll INTEGER, user INTEGER, choice TEXT, PRIMARY KEY (poll, user, choice));
+        ''')
+        for poll_id, channel_id, author_id, title, options, multiple_choice, closed in await self.database.fetch('SELECT * FROM polls'):
+            self.polls[poll_id] = Poll(channel_id, author_id, title, json.loads(options), bool(multiple_choice), bool(closed))
+            self.bot.reactions.register(poll_id, self)
+        for poll_id, user_id, emoji in await self.database.fetch('SELECT * FROM votes'):
+            self.polls[poll_id].vote(user_id, emoji)
+
+    async def on_reaction_add(self, payload: discord.RawReactionActionEvent):
+        poll = self.polls.get(payload.message_id)
+        if poll is None or payload.user_id == id_dict['bot']: return
+        emoji = str(payload.emoji)
+        message = self.bot.get_partial_messageable(payload.channel_id).get_partial_message(payload.message_id)
+        # only allow poll-specific reactions
+        if emoji not in (option_emoji for option_emoji, _ in poll.options):
+            return await message.clear_reaction(payload.emoji)
+        # a repeated event for a vote that is already counted changes nothing
+        if emoji in poll.votes.get(payload.user_id, ()):
+            return
+        # only allow one reaction per user if not multiple-choice
+        if poll.closed or (not poll.multiple_choice and payload.user_id in poll.votes):
+            return await message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+        if poll.vote(payload.user_id, emoji):
+            await self.database.execute('INSERT OR IGNORE INTO votes VALUES (?, ?, ?)', (payload.message_id, payload.user_id, emoji))
+
+    async def on_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        poll = self.polls.get(payload.message_id)
+        # the counts of a closed poll are final
+        if poll is None or poll.closed: return
+        if poll.unvote(payload.user_id, str(payload.emoji)):
+            await self.database.execute('DELETE FROM votes WHERE poll = ? AND user = ? AND choice = ?', (payload.message_id, payload.user_id, str(payload.emoji)))
 
     @app_commands.command(name='poll', description='Create an emoji reaction poll.')
     async def _poll(self, interaction: discord.Interaction, title: str, options: str = None, multiple_choice: bool = False):
         content = f'**[{"Multi-" if multiple_choice else ""}Poll] {title}**'
         if options is None:
-            await interaction.response.send_message(content)
-            message = await interaction.original_response()
-            for emoji in ('\u2705', '\u274E'):
-                await message.add_reaction(emoji)
+            options = [('\u2705', 'Yes'), ('\u274E', 'No')]
         else:
             options = options.split(',')
             if len(options) > 10:
                 raise app_commands.AppCommandError(f'{interaction.user.name} provided too many options for a poll.')
-            for emoji, option in zip(self.emojis, options):
-                content += f'\n{emoji} {option.lstrip()}'
-            await interaction.response.send_message(content)
-            message = await interaction.original_response()
-            for i, emoji in enumerate(self.emojis):
-                await message.add_reaction(emoji)
-                if i == len(options) - 1: break
+            options = [(emoji, option.lstrip()) for emoji, option in zip(self.emojis, options)]
+            for emoji, option in options:
+                content += f'\n{emoji} {option}'
+        await interaction.response.send_message(content)
+        message = await interaction.original_response()
+        self.polls[message.id] = Poll(interaction.channel.id, interaction.user.id, title, options, multiple_choice)
+        self.bot.reactions.register(message.id, self)
+        await self.database.execute('INSERT INTO polls VALUES (?, ?, ?, ?, ?, ?, 0)',
+            (message.id, interaction.channel.id, interaction.user.id, title, json.dumps(options), multiple_choice))
+        self.bot.reactions.seed(message, [emoji for emoji, _ in options])
+
+    @app_commands.command(name='results', description='Show the results of a poll, optionally closing it.')
+    async def _results(self, interaction: discord.Interaction, poll: str, close: bool = False):
+        # accepts a message id or a message link
+        poll_id = poll.rsplit('/', 1)[-1]
+        if not poll_id.isdigit() or int(poll_id) not in self.polls:
+            raise app_commands.AppCommandError(f'{interaction.user.name} provided an unknown poll.')
+        poll_id, poll = int(poll_id), self.polls[int(poll_id)]
+        if close and not poll.closed:
+            if interaction.user.id != poll.author_id:
+                raise app_commands.AppCommandError(f'{interaction.user.name} can\'t close another user\'s poll.')
+            poll.closed = True
+            await self.database.execute('UPDATE polls SET closed = 1 WHERE id = ?', (poll_id,))
+
+        description = ''
+        for emoji, option in poll.options:
+            description += f'{emoji} {option} **({poll.counts[emoji]})**\n'
+        embed = discord.Embed(title=f'{"[Closed] " if poll.closed else ""}{poll.title}', description=description,
+            color=discord.Color.gold()).set_footer(text=f'{len(poll.votes)} Voters')
+        await interaction.response.send_message(embed=embed)
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(PollBot(bot))
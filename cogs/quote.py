@@ -1,25 +1,43 @@
 from nltk.tokenize import word_tokenize
-from collections import Counter
+from collections import Counter, defaultdict
 
 from discord import app_commands
-from discord.ext import commands
-import discord, random, json
+from discord.ext import commands, tasks
+import discord, random, json, os
 
 class QuoteBot(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.load_quotes()
+        self.reload_task.start()
+
+    def cog_unload(self):
+        self.reload_task.cancel()
+
+    def load_quotes(self):
+        self.mtime = os.path.getmtime('data/quotes.json')
         with open('data/quotes.json') as quotes_file:
             self.quotes = Counter(json.load(quotes_file))
+        # alias -> quote bots answering to it, so each message is tokenized once
+        self.aliases = defaultdict(list)
+        for qbot in self.quotes:
+            for alias in qbot.split(', '):
+                self.aliases[alias.lower()].append(qbot)
+        self.order = {qbot: i for i, qbot in enumerate(self.quotes)}
+
+    @tasks.loop(seconds=30)
+    async def reload_task(self):
+        if os.path.getmtime('data/quotes.json') != self.mtime:
+            self.load_quotes()
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author == self.bot.user: return
-        for qbot in self.quotes:
-            for alias in qbot.split(', '):
-                if alias.lower() in word_tokenize(message.content.lower()):
-                    await message.channel.send(random.choice(self.quotes[qbot])
-                        .replace('<@>', f'<@{message.author.id}>'))
+        qbots = {qbot for token in set(word_tokenize(message.content.lower())) for qbot in self.aliases.get(token, ())}
+        for qbot in sorted(qbots, key=self.order.get):
+            await message.channel.send(random.choice(self.quotes[qbot])
+                .replace('<@>', f'<@{message.author.id}>'))
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(QuoteBot(bot))
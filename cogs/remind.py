@@ -1,11 +1,13 @@
 from discord import app_commands
-from discord.ext import commands, tasks
-import discord, json
+from discord.ext import commands
+import discord, asyncio, heapq, json, os, time
 
 from datetime import datetime
 from dateparser import parse
 from pytz import timezone
 
+from cogs.utils.database import Database
+
 with open('data/id_dict.json') as id_file:
     id_dict = json.load(id_file)
 
@@ -13,53 +15,97 @@ class RemindBot(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.sleep_timers = []
-        with open('data/reminders.json') as reminders_file:
-            self.reminders = json.load(reminders_file)
-        self.remind_task.start()
-        self.counter = 0
+        # min-heap of (timestamp, id, kind, payload) for reminders and sleep timers alike
+        self.timers = []
+        self.cancelled = set()
+        self.sleep_timers = {}
+        self.wakeup = asyncio.Event()
+        self.database = Database('data/reminders.db')
+        self.task = None
+
+    async def cog_load(self):
+        await self.database.executescript('''
+            CREATE TABLE IF NOT EXISTS timers (id INTEGER PRIMARY KEY, kind TEXT, who INTEGER, channel INTEGER, message TEXT, due REAL);
+            CREATE INDEX IF NOT EXISTS timers_due ON timers (due);
+        ''')
+        if os.path.exists('data/reminders.json'):
+            # one-time import of reminders saved before the database existed
+            with open('data/reminders.json') as reminders_file:
+                reminders = json.load(reminders_file)
+            await self.database.executemany('INSERT INTO timers (kind, who, channel, message, due) VALUES (?, ?, ?, ?, ?)',
+                [('reminder', who_id, channel_id, what, datetime.fromisoformat(when).timestamp()) for who_id, channel_id, what, when in reminders])
+            os.replace('data/reminders.json', 'data/reminders.json.bak')
+        for timer_id, kind, who_id, channel_id, what, due in await self.database.fetch('SELECT * FROM timers'):
+            self.timers.append((due, timer_id, kind, (who_id, channel_id, what) if kind == 'reminder' else who_id))
+            if kind == 'sleep':
+                self.sleep_timers[who_id] = timer_id
+        heapq.heapify(self.timers)
+        self.task = self.bot.loop.create_task(self.remind_task())
+
+    def cog_unload(self):
+        if self.task:
+            self.task.cancel()
+
+    async def schedule(self, when: datetime, kind: str, payload):
+        who_id, channel_id, what = payload if kind == 'reminder' else (payload, None, None)
+        timer_id = await self.database.execute('INSERT INTO timers (kind, who, channel, message, due) VALUES (?, ?, ?, ?, ?)',
+            (kind, who_id, channel_id, what, when.timestamp()))
+        heapq.heappush(self.timers, (when.timestamp(), timer_id, kind, payload))
+        if self.timers[0][1] == timer_id:
+            self.wakeup.set()
+        return timer_id
+
+    async def cancel(self, timer_id: int):
+        self.cancelled.add(timer_id)
+        await self.database.execute('DELETE FROM timers WHERE id = ?', (timer_id,))
 
-    @tasks.loop(seconds=1)
     async def remind_task(self):
-        def diff(A, B):
-            return [x for x in A if x not in B]
-        now = timezone('EST').localize(datetime.now())
-        completed, reminded = [], False
-        for reminder in self.reminders:
-            who_id, channel_id, message, when = reminder
+        await self.bot.wait_until_ready()
+        while True:
+            self.wakeup.clear()
+            # overdue timers (e.g. from before a restart) fire as soon as the bot is up
+            while self.timers and self.timers[0][0] <= time.time():
+                _, timer_id, kind, payload = heapq.heappop(self.timers)
+                if timer_id in self.cancelled:
+                    self.cancelled.discard(timer_id)
+                    continue
+                await self.database.execute('DELETE FROM timers WHERE id = ?', (timer_id,))
+                try:
+                    await self.fire(kind, payload)
+                except discord.HTTPException:
+                    pass
+            delay = self.timers[0][0] - time.time() if self.timers else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fire(self, kind: str, payload):
+        if kind == 'reminder':
+            who_id, channel_id, message = payload
             channel = self.bot.get_channel(channel_id)
-            when = datetime.fromisoformat(when)
-            if abs((now - when).total_seconds()) < 1.:
-                completed.append(reminder)
+            if channel:
                 await channel.send(f'**[Reminder]** <@{who_id}> {message}')
-                reminded = True
-        if len(completed) > 0:
-            self.reminders = diff(self.reminders, completed)
-        guild = self.bot.get_guild(id_dict['guild'])
-        for timer in self.sleep_timers:
-            who_id, when = timer
-            if abs((now - when).total_seconds()) < 1.:
-                completed.append(timer)
-                await guild.get_member(who_id).move_to(None)
-        if len(completed) > 0:
-            self.sleep_timers = diff(self.sleep_timers, completed)
-        if reminded:
-            with open('data/reminders.json', 'w') as reminders_file:
-                json.dump(list(self.reminders), reminders_file)
+        elif kind == 'sleep':
+            self.sleep_timers.pop(payload, None)
+            member = self.bot.get_guild(id_dict['guild']).get_member(payload)
+            if member:
+                await member.move_to(None)
 
     @app_commands.command(name='remind', description='Set a reminder for a specific date/time.')
     async def _remind(self, interaction: discord.Interaction, what: str, when: str, who: discord.User = None):
         who_id = interaction.user.id if who is None else who.id
         when = timezone('EST').localize(parse(when))
-        self.reminders.append((who_id, interaction.channel.id, what, when.isoformat()))
-        with open('data/reminders.json', 'w') as reminders_file:
-                json.dump(list(self.reminders), reminders_file)
+        await self.schedule(when, 'reminder', (who_id, interaction.channel.id, what))
         await interaction.response.send_message(f'<@{who_id}> will be reminded at {when.strftime("%I:%M:%S %p")} on {when.strftime("%m-%d-%Y")}.')
 
     @app_commands.command(name='sleep', description='Set a sleep timer to disconnect from a voice channel.')
     async def _sleep(self, interaction: discord.Interaction, when: str):
         when = timezone('EST').localize(parse(when))
-        self.sleep_timers.append((interaction.user.id, when))
+        # a new sleep timer replaces the previous one
+        if interaction.user.id in self.sleep_timers:
+            await self.cancel(self.sleep_timers[interaction.user.id])
+        self.sleep_timers[interaction.user.id] = await self.schedule(when, 'sleep', interaction.user.id)
         await interaction.response.send_message(f'<@{interaction.user.id}> will be disconnected at {when.strftime("%I:%M:%S %p")} on {when.strftime("%m-%d-%Y")}.')
 
 async def setup(bot: commands.Bot):
@@ -1,25 +1,78 @@
 from discord.ext import commands
 from aiohttp import web
-import asyncio
+import asyncio, hashlib, json
+
+from cogs.utils import metrics
 
 class Server(commands.Cog):
 
+    # idle event streams send a comment this often so dead clients are noticed
+    KEEPALIVE = 30
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.site = None
+        # guild id -> status, kept current from events and served as one prebuilt body
+        self.guilds = {}
+        self.body = b'{}'
+        self.etag = None
+        self.changed = asyncio.Event()
         self.bot.loop.create_task(self.start_server())
 
-    async def get_status(self, request):
-        activity = self.bot.guilds[0].get_member(self.bot.user.id).activity
-        activity_name = activity.name if activity else 'Nothing Playing'
-        voice_client = self.bot.guilds[0].voice_client
-        channel_name = voice_client.channel.name if voice_client else '-'
+    def update(self, guild, **status):
+        self.guilds.setdefault(guild.id, {'guild': guild.name, 'activity': 'Nothing Playing', 'channel': '-'}).update(status)
+        self.publish()
+
+    def publish(self):
+        # the first guild is also reported at the top level, as before
+        primary = self.guilds.get(self.bot.guilds[0].id, {}) if self.bot.guilds else {}
         # 'ping': round(self.bot.latency * 1000)
-        return web.json_response({'activity': activity_name, 'channel': channel_name})
+        self.body = json.dumps({'activity': primary.get('activity', 'Nothing Playing'), 'channel': primary.get('channel', '-'),
+            'guilds': {str(guild_id): status for guild_id, status in self.guilds.items()}}).encode()
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=8).hexdigest() + '"'
+        # wake every open stream, later waiters get a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.id == self.bot.user.id:
+            self.update(member.guild, channel=after.channel.name if after.channel else '-')
+
+    @commands.Cog.listener()
+    async def on_track_change(self, guild, data):
+        self.update(guild, activity=data['title'] if data else 'Nothing Playing')
+
+    async def get_status(self, request):
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache'}
+        if request.headers.get('If-None-Match') == self.etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=self.body, content_type='application/json', headers=headers)
+
+    async def get_stream(self, request):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        try:
+            while True:
+                changed = self.changed
+                await response.write(b'data: ' + self.body + b'\n\n')
+                while not changed.is_set():
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        await response.write(b': keepalive\n\n')
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def get_metrics(self, request):
+        return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
     async def start_server(self):
         app = web.Application()
         app.router.add_get('/api', self.get_status)
+        app.router.add_get('/api/stream', self.get_stream)
+        app.router.add_get('/metrics', self.get_metrics)
 
         runner = web.AppRunner(app)
         await runner.setup()
@@ -27,10 +80,14 @@ class Server(commands.Cog):
         self.api = web.TCPSite(runner, '0.0.0.0', 8093)
 
         await self.bot.wait_until_ready()
+        for guild in self.bot.guilds:
+            self.guilds.setdefault(guild.id, {'guild': guild.name, 'activity': 'Nothing Playing',
+                'channel': guild.voice_client.channel.name if guild.voice_client else '-'})
+        self.publish()
         await self.api.start()
         print('API Server Started.')
 
-    def __unload(self):
+    def cog_unload(self):
         asyncio.ensure_future(self.api.stop())
         print('API Server Stopped.')
 
@@ -1,45 +1,204 @@
 from discord import app_commands
-from discord.ext import commands
-import discord, torch, toml, json
+from discord.ext import commands, tasks
+import discord, torch, toml, json, asyncio, collections, gc, os, re, statistics, time
 
 from translation.manager import Manager, Tokenizer
 from translation.translate import translate_string
 from translation.detect import detect_lang
 
+from cogs.utils import memory
+from cogs.utils.executor import Executor
+from cogs.utils.lru import LRUCache
+
 with open('data/id_dict.json') as id_file:
     id_dict = json.load(id_file)
 
+class InferenceWorker:
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        # a single dedicated thread, so torch never competes with itself for cores
+        self.executor = Executor(max_workers=1, name='inference')
+        self.latencies = collections.deque(maxlen=1000)
+        self.served = 0
+        self.task = asyncio.get_running_loop().create_task(self.worker_task())
+
+    async def submit(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, future, time.perf_counter()))
+        return await future
+
+    async def worker_task(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # work starts as soon as the worker is idle, taking along whatever queued up while it was busy;
+            # a window only holds the batch open longer, which pays off when batches share a forward pass
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                if (remaining := deadline - loop.time()) <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await self.executor.run(self.run_batch, [(func, args) for func, args, _, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            now = time.perf_counter()
+            for (_, _, future, start), result in zip(batch, results):
+                if future.done(): continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                self.latencies.append(now - start)
+            self.served += len(batch)
+            if self.served % 100 < len(batch):
+                self.report()
+
+    @staticmethod
+    def run_batch(batch: list):
+        # identical requests in a batch (e.g. the same message detected twice) are computed once
+        results = {}
+        with torch.inference_mode():
+            for func, args in batch:
+                if (func, args) not in results:
+                    try:
+                        results[func, args] = func(*args)
+                    except Exception as e:
+                        results[func, args] = e
+        return [results[func, args] for func, args in batch]
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        p50 = statistics.median(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * .99))]
+        print(f'Inference Latency (window {self.window * 1000:.0f}ms, p50 {p50 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms, {self.served} served).')
+
 class TranslateBot(commands.Cog):
 
+    # batch window and size of the inference worker, and the torch threads it may use;
+    # requests run one by one within a batch, so waiting for more of them only adds latency
+    BATCH_WINDOW = 0.
+    MAX_BATCH = 16
+    TORCH_THREADS = 4
+
+    # translation models are loaded on first use, int8-quantized, and dropped after being idle
+    QUANTIZE = True
+    IDLE_TIMEOUT = 1800
+    MAX_TRANSLATORS = 1
+    LANGUAGES = {'de': 'German'}
+
+    # urls, custom emojis and mentions carry no language
+    IGNORED = re.compile(r'https?://\S+|<a?:\w+:\d+>|<[@#][!&]?\d+>')
+    WORDS = re.compile(r'[^\W\d_]+')
+    MIN_LETTERS = 3
+    # frequent words that are unambiguous between english and german chatter
+    ENGLISH = frozenset('the and you that this with have are not but what for just like yeah yes it is of to my me be do can if on at they we he she how why when there lol ok'.split())
+    GERMAN = frozenset('der die das und ist nicht ich du wir ihr sie ein eine zu mit auf sich auch noch aber wie hat bin bist sind mir mich dich kann doch ja nein schon jetzt oder wenn dann'.split())
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        torch.set_num_threads(self.TORCH_THREADS)
+        self.worker = InferenceWorker(self.BATCH_WINDOW, self.MAX_BATCH)
+        self.detections = LRUCache(4096)
+        self.translations = LRUCache(1024)
 
         with open('translation/model.config') as file:
-            config = toml.load(file)
-        device = torch.device('cpu')
+            self.config = toml.load(file)
+        self.model_detect = None
+        # (src_lang, tgt_lang) -> (manager, tokenizer), least recently used first
+        self.translators = collections.OrderedDict()
+        self.last_used = {}
+        self.directions = {(src_lang, tgt_lang) for src_lang, tgt_lang in (('de', 'en'), ('en', 'de'))
+            if os.path.exists(f'translation/data/model_large.{src_lang}{tgt_lang}')}
+
+    async def cog_load(self):
+        # the detection model is needed for almost every message, so start loading it right away
+        self.bot.loop.create_task(self.load_detect())
+        self.idle_task.start()
+
+    def cog_unload(self):
+        self.idle_task.cancel()
+        self.worker.task.cancel()
+
+    async def load_detect(self):
+        if self.model_detect is None:
+            self.model_detect = await self.worker.executor.run(self.load, 'detect', key='detect')
+        return self.model_detect
 
-        self.model_detect = torch.load('translation/data/model_detect')
+    async def load_translator(self, src_lang: str, tgt_lang: str):
+        direction = (src_lang, tgt_lang)
+        self.last_used[direction] = time.monotonic()
+        if direction not in self.translators:
+            translator = await self.worker.executor.run(self.load, src_lang + tgt_lang, key=direction)
+            self.translators[direction] = translator
+            while len(self.translators) > self.MAX_TRANSLATORS:
+                self.translators.popitem(last=False)
+        self.translators.move_to_end(direction)
+        return self.translators[direction]
 
-        # self.manager_ende = Manager('en', 'de', config, device, vocab_file='translation/data/vocab.ende')
-        # self.tokenizer_ende = Tokenizer('en', 'de', 'translation/data/codes.ende')
-        # self.manager_ende.load_model('translation/data/model_large.ende')
-        # self.manager_ende.model.eval()
+    def load(self, name: str):
+        start = time.perf_counter()
+        if name == 'detect':
+            model = torch.load('translation/data/model_detect')
+        else:
+            manager = Manager(name[:2], name[2:], self.config, torch.device('cpu'), vocab_file=f'translation/data/vocab.{name}')
+            tokenizer = Tokenizer(name[:2], name[2:], f'translation/data/codes.{name}')
+            manager.load_model(f'translation/data/model_large.{name}')
+            manager.model.eval()
+            if self.QUANTIZE:
+                manager.model = torch.quantization.quantize_dynamic(manager.model, {torch.nn.Linear}, dtype=torch.qint8)
+            model = (manager, tokenizer)
+        print(f'Model Loaded ({name}, {time.perf_counter() - start:.1f}s, {memory.describe()}).')
+        return model
+
+    @tasks.loop(minutes=1)
+    async def idle_task(self):
+        for direction in list(self.translators):
+            if time.monotonic() - self.last_used[direction] > self.IDLE_TIMEOUT:
+                del self.translators[direction]
+                gc.collect()
+
+    async def detect(self, text: str):
+        key = ' '.join(text.lower().split())
+        if key in self.detections:
+            return self.detections.get(key)
+        words = self.WORDS.findall(self.IGNORED.sub(' ', key))
+        if sum(map(len, words)) < self.MIN_LETTERS:
+            src_lang = None
+        elif key.isascii() and sum(word in self.ENGLISH for word in words) >= 2 \
+            and not any(word in self.GERMAN for word in words):
+                src_lang = 'en'
+        else:
+            src_lang = await self.worker.submit(detect_lang, text, await self.load_detect())
+        self.detections[key] = src_lang
+        return src_lang
 
-        self.manager_deen = Manager('de', 'en', config, device, vocab_file='translation/data/vocab.deen')
-        self.tokenizer_deen = Tokenizer('de', 'en', 'translation/data/codes.deen')
-        self.manager_deen.load_model('translation/data/model_large.deen')
-        self.manager_deen.model.eval()
+    async def translate(self, text: str, src_lang: str, tgt_lang: str):
+        # whitespace variants share a cache entry, the model still sees the text as written
+        key = (src_lang, tgt_lang, ' '.join(text.split()))
+        if key not in self.translations:
+            manager, tokenizer = await self.load_translator(src_lang, tgt_lang)
+            self.translations[key] = await self.worker.submit(translate_string, text, manager, tokenizer)
+        return self.translations.get(key)
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.id == id_dict['bot']: return
-        src_lang = detect_lang(message.content, self.model_detect)
+        src_lang = await self.detect(message.content)
         if src_lang is None: return
         if src_lang != 'en':
-            if src_lang != 'de': return
-            title = 'German'
-            output = translate_string(message.content, self.manager_deen, self.tokenizer_deen)
-            embed = discord.Embed(title=f"Translation ({'to' if src_lang == 'en' else 'from'} {title})",
+            if (src_lang, 'en') not in self.directions: return
+            output = await self.translate(message.content, src_lang, 'en')
+            embed = discord.Embed(title=f"Translation (from {self.LANGUAGES[src_lang]})",
                 description=output, color=discord.Color.green())
             await message.reply(embed=embed)
 
@@ -47,16 +206,13 @@ class TranslateBot(commands.Cog):
     async def _translate(self, interaction: discord.Interaction, string: str, src_lang: str = None, tgt_lang: str = None):
         await interaction.response.defer()
         if src_lang is None:
-            src_lang = detect_lang(string, self.model_detect)
+            src_lang = await self.detect(string)
         if tgt_lang is None:
             tgt_lang = 'en'
 
-        # if src_lang == 'en' and tgt_lang == 'de':
-        #     title = 'German'
-        #     output = translate_string(string, self.manager_ende, self.tokenizer_ende)
-        if src_lang == 'de' and tgt_lang == 'en':
-            title = 'German'
-            output = translate_string(string, self.manager_deen, self.tokenizer_deen)
+        if (src_lang, tgt_lang) in self.directions:
+            title = self.LANGUAGES[tgt_lang if src_lang == 'en' else src_lang]
+            output = await self.translate(string, src_lang, tgt_lang)
         else:
             return await interaction.followup.send('Unsupported Translation.')
 
@@ -0,0 +1,45 @@
+import json, sqlite3, threading, time
+
+class Cache:
+
+    def __init__(self, path: str, table: str, ttl: float, budget: int):
+        self.table = table
+        self.ttl = ttl
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, stored REAL, accessed REAL, size INTEGER)')
+        self.db.execute(f'CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)')
+        self.size = self.db.execute(f'SELECT COALESCE(SUM(size), 0) FROM {table}').fetchone()[0]
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.db.execute(f'SELECT value, stored FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.db.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, value):
+        value = json.dumps(value)
+        with self.lock:
+            row = self.db.execute(f'SELECT size FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            self.size += len(value) - (row[0] if row else 0)
+            now = time.time()
+            self.db.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?)', (key, value, now, now, len(value)))
+            if self.size > self.budget:
+                self.evict()
+
+    def evict(self):
+        # drop least recently used rows until the table fits its budget again
+        keys = []
+        for key, size in self.db.execute(f'SELECT key, size FROM {self.table} ORDER BY accessed'):
+            if self.size <= self.budget: break
+            keys.append((key,))
+            self.size -= size
+        self.db.executemany(f'DELETE FROM {self.table} WHERE key = ?', keys)
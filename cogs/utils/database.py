@@ -0,0 +1,35 @@
+import sqlite3
+
+from cogs.utils.executor import Executor
+
+class Database:
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # a single worker keeps statements ordered and off the event loop
+        self.executor = Executor(max_workers=1, name='database')
+
+    async def execute(self, sql: str, params=()):
+        return await self.executor.run(self._execute, sql, params)
+
+    async def executemany(self, sql: str, params):
+        return await self.executor.run(self._executemany, sql, params)
+
+    async def executescript(self, sql: str):
+        return await self.executor.run(self.db.executescript, sql)
+
+    async def fetch(self, sql: str, params=()):
+        return await self.executor.run(self._fetch, sql, params)
+
+    def _execute(self, sql: str, params):
+        return self.db.execute(sql, params).lastrowid
+
+    def _executemany(self, sql: str, params):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(sql, params)
+
+    def _fetch(self, sql: str, params):
+        return self.db.execute(sql, params).fetchall()
@@ -0,0 +1,36 @@
+import asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+
+class Executor:
+
+    def __init__(self, max_workers: int, timeout: float = None, name: str = None):
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix=name or '')
+        self.timeout = timeout
+        self.pending = {}
+        self.depth = 0
+        self.coalesced = 0
+
+    async def run(self, func, *args, key=None, timeout: float = None, **kwargs):
+        # identical lookups share the call that is already in flight
+        if key is not None and key in self.pending:
+            self.coalesced += 1
+            future = self.pending[key]
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+            self.depth += 1
+            future.add_done_callback(functools.partial(self.done, key))
+            if key is not None:
+                self.pending[key] = future
+        # the worker thread cannot be interrupted, so a timeout only abandons the result
+        return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+
+    def done(self, key, future: asyncio.Future):
+        self.depth -= 1
+        if key is not None:
+            self.pending.pop(key, None)
+        if not future.cancelled():
+            future.exception()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,24 @@
+import os, sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def rss(pid: int = None):
+    # current resident set size in MiB where /proc exists, otherwise the peak, or None where neither is known
+    try:
+        with open(f'/proc/{pid or "self"}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        pass
+    # only this process can be measured without /proc
+    if resource is None or pid is not None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def describe():
+    memory = rss()
+    return 'RSS unknown' if memory is None else f'{memory:.0f} MiB RSS'
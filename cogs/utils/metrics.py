@@ -0,0 +1,98 @@
+import bisect, threading, time
+
+# name -> metric, rendered in the prometheus text format by render()
+registry = {}
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        # label values -> value, or a callable sampled when scraped
+        self.values = {}
+        registry[name] = self
+
+    @staticmethod
+    def key(labels: dict):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def format(key: tuple, extra: tuple = ()):
+        labels = ','.join(f'{name}="{value}"' for name, value in key + extra)
+        return '{' + labels + '}' if labels else ''
+
+    def track(self, func, **labels):
+        # for values that another object already keeps count of
+        self.values[self.key(labels)] = func
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield f'{self.name}{self.format(key)} {value() if callable(value) else value}'
+
+    def render(self):
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # per bucket counts, then the sum and count of all observations
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 3))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        for key, counts in list(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield f'{self.name}_bucket{self.format(key, (("le", bound),))} {total}'
+            yield f'{self.name}_sum{self.format(key)} {counts[-2]}'
+            yield f'{self.name}_count{self.format(key)} {counts[-1]}'
+
+class Timer:
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+def render():
+    return '\n'.join(metric.render() for metric in registry.values()) + '\n'
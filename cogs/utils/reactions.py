@@ -0,0 +1,67 @@
+from collections import defaultdict
+from discord.ext import commands
+import discord, asyncio, traceback
+
+class Reactions:
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        # message id -> owner, and emoji -> handlers interested in any message
+        self.owners = {}
+        self.emojis = defaultdict(list)
+        self.pending = {}
+        bot.add_listener(self.on_raw_reaction_add)
+        bot.add_listener(self.on_raw_reaction_remove)
+
+    def register(self, message_id: int, owner):
+        self.owners[message_id] = owner
+
+    def unregister(self, message_id: int):
+        self.owners.pop(message_id, None)
+
+    def subscribe(self, emoji: str, handler):
+        self.emojis[emoji].append(handler)
+
+    def seed(self, message: discord.Message, emojis):
+        # reactions are added in the background, paced by the http client's rate limit buckets
+        return self.bot.loop.create_task(self.seed_task(message, emojis))
+
+    async def seed_task(self, message: discord.Message, emojis):
+        for emoji in emojis:
+            try:
+                await message.add_reaction(emoji)
+            except discord.NotFound:
+                return
+
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        await self.dispatch('on_reaction_add', payload)
+
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        await self.dispatch('on_reaction_remove', payload)
+
+    async def dispatch(self, event: str, payload: discord.RawReactionActionEvent):
+        handlers = self.emojis.get(str(payload.emoji), [])
+        if payload.message_id in self.owners:
+            handlers = [self.owners[payload.message_id]] + handlers
+        for handler in handlers:
+            if hasattr(handler, event):
+                # a failing handler is logged and must not keep the reaction from the rest
+                try:
+                    await getattr(handler, event)(payload)
+                except Exception as e:
+                    print(f'Reaction Handler Failed ({type(handler).__name__}, {e!r}).')
+                    traceback.print_exc()
+
+    async def fetch_message(self, payload: discord.RawReactionActionEvent):
+        # the gateway keeps reactions of cached messages current, a fetched copy is only good for this event
+        message = discord.utils.get(self.bot.cached_messages, id=payload.message_id)
+        if message is None:
+            # handlers of the same reaction share a single request
+            if payload.message_id not in self.pending:
+                channel = self.bot.get_partial_messageable(payload.channel_id)
+                self.pending[payload.message_id] = asyncio.ensure_future(channel.fetch_message(payload.message_id))
+            try:
+                message = await asyncio.shield(self.pending[payload.message_id])
+            finally:
+                self.pending.pop(payload.message_id, None)
+        return message
@@ -1,6 +1,9 @@
+from collections import defaultdict
 from discord import app_commands
 from discord.ext import commands
-import discord, json, re
+import discord, asyncio, json, re
+
+from cogs.utils.database import Database
 
 with open('data/id_dict.json') as id_file:
     id_dict = json.load(id_file)
@@ -11,34 +14,74 @@ class VoiceBot(commands.Cog):
         self.bot = bot
         self.voice_room = int(id_dict['voice-room'])
         self.bitrate = 128000 # default bitrate
-        self.channels = []
+        # temporary channel id -> owner id, and owner id -> their temporary channel ids
+        self.channels = {}
+        self.owned = defaultdict(set)
+        self.database = Database('data/voice.db')
+
+    async def cog_load(self):
+        await self.database.execute('CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, owner INTEGER)')
+        for channel_id, owner_id in await self.database.fetch('SELECT * FROM channels'):
+            self.add(channel_id, owner_id)
+        self.bot.loop.create_task(self.sweep())
+
+    def add(self, channel_id: int, owner_id: int):
+        self.channels[channel_id] = owner_id
+        self.owned[owner_id].add(channel_id)
+
+    def discard(self, channel_id: int):
+        owner_id = self.channels.pop(channel_id)
+        self.owned[owner_id].discard(channel_id)
+        if not self.owned[owner_id]:
+            del self.owned[owner_id]
+
+    async def sweep(self):
+        # channels left behind by a restart are deleted together once the cache is ready
+        await self.bot.wait_until_ready()
+        orphans, channels = [], []
+        for channel_id in list(self.channels):
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or not channel.members:
+                self.discard(channel_id)
+                orphans.append((channel_id,))
+                # channels deleted while the bot was offline only need their row removed
+                if channel:
+                    channels.append(channel)
+        await self.database.executemany('DELETE FROM channels WHERE id = ?', orphans)
+        await asyncio.gather(*(channel.delete() for channel in channels), return_exceptions=True)
 
     @app_commands.command(name='channel', description='Customize the settings of a temporary voice channel.')
     async def _channel(self, interaction: discord.Interaction, name: str = None, status: str = None, limit: int = None):
         channel = interaction.user.voice.channel
         if channel.id in self.channels:
+            # every setting goes out in a single edit
+            changes = {}
             if name and len(name) > 0:
-                await channel.edit(name=name)
+                changes['name'] = name
             if status and len(status) > 0:
-                await channel.edit(status=status)
+                changes['status'] = status
             if limit and limit > 0:
-                await channel.edit(user_limit=limit)
+                changes['user_limit'] = limit
+            if changes:
+                await channel.edit(**changes)
             await interaction.response.send_message(f'Updated Settings for <#{channel.id}>.', delete_after=5)
         else:
             await interaction.response.send_message(f'Permission Denied for <#{channel.id}>.', delete_after=5)
 
     async def create_channel(self, member, category):
-        count = len([channel for channel in self.channels if member.nick in channel.name]) + 1
-        channel = await category.create_voice_channel(f'{member.nick}\'s Channel #{count}', bitrate=self.bitrate)
-        self.channels.append(channel.id)
+        count = len(self.owned.get(member.id, ())) + 1
+        channel = await category.create_voice_channel(f'{member.display_name}\'s Channel #{count}', bitrate=self.bitrate)
+        self.add(channel.id, member.id)
+        await self.database.execute('INSERT INTO channels VALUES (?, ?)', (channel.id, member.id))
         await member.move_to(channel)
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
         if before.channel:
-            if before.channel.id in self.channels and len(self.bot.get_channel(before.channel.id).members) == 0:
-                self.channels.remove(before.channel.id)
-                await self.bot.get_channel(before.channel.id).delete()
+            if before.channel.id in self.channels and len(before.channel.members) == 0:
+                self.discard(before.channel.id)
+                await self.database.execute('DELETE FROM channels WHERE id = ?', (before.channel.id,))
+                await before.channel.delete()
         if after.channel:
             if after.channel.id == self.voice_room:
                 await self.create_channel(member, after.channel.category)
@@ -1,30 +1,85 @@
 from translation.detect import Model
 from discord.ext import commands
-import discord, json
+import discord, aiohttp, asyncio, hashlib, json, os, time
+
+from cogs.utils import memory
+from cogs.utils.reactions import Reactions
 
 class DiscordBot(commands.Bot):
 
-    cogs = (
-        'music',
-        'quote',
-        'poll',
-        'pin',
-        'remind',
-        'insult',
-        'translate',
-    )
+    # each cog with the gateway intents, member caches and message cache it relies on,
+    # the bot only asks for what the loaded cogs need between them; deferred cogs load once connected
+    cogs = {
+        'music':     {'intents': ('guilds', 'guild_messages', 'guild_reactions', 'voice_states'), 'members': ('voice',), 'messages': 100},
+        'quote':     {'intents': ('guild_messages', 'message_content')},
+        'poll':      {'intents': ('guild_reactions',)},
+        'pin':       {'intents': ('guild_messages', 'guild_reactions'), 'messages': 1000},
+        'remind':    {'intents': ('guilds', 'voice_states'), 'members': ('voice',)},
+        'insult':    {},
+        'translate': {'intents': ('guild_messages', 'message_content'), 'defer': True},
+        'server':    {'intents': ('guilds', 'voice_states')},
+    }
 
     def __init__(self):
-        super().__init__(command_prefix='!', intents=discord.Intents.all())
+        self.started = time.perf_counter()
+        intents, members, messages = self.profile()
+        super().__init__(command_prefix='!', intents=intents, member_cache_flags=members, max_messages=messages)
+
+    @classmethod
+    def profile(cls):
+        intents, members, messages = discord.Intents.none(), discord.MemberCacheFlags.none(), 0
+        for requirements in cls.cogs.values():
+            for intent in requirements.get('intents', ()):
+                setattr(intents, intent, True)
+            for flag in requirements.get('members', ()):
+                setattr(members, flag, True)
+            # reaction handlers read messages from the gateway cache before falling back to http
+            messages = max(messages, requirements.get('messages', 0))
+        return intents, members, messages or None
 
     async def setup_hook(self):
-        for cog in self.cogs:
-            await self.load_extension('cogs.' + cog)
-        await bot.tree.sync()
+        # one pooled session shared by every cog that talks http
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=10, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10))
+        self.reactions = Reactions(self)
+        await asyncio.gather(*(self.load(cog) for cog, requirements in self.cogs.items() if not requirements.get('defer')))
+        self.loop.create_task(self.load_deferred())
+
+    async def load(self, cog: str):
+        start = time.perf_counter()
+        await self.load_extension('cogs.' + cog)
+        print(f'Cog Loaded ({cog}, {time.perf_counter() - start:.2f}s).')
+
+    async def load_deferred(self):
+        await self.wait_until_ready()
+        deferred = [cog for cog, requirements in self.cogs.items() if requirements.get('defer')]
+        # a cog that fails to load must not keep the others' commands from being synced
+        for cog, result in zip(deferred, await asyncio.gather(*map(self.load, deferred), return_exceptions=True)):
+            if isinstance(result, Exception):
+                print(f'Cog Failed ({cog}, {result!r}).')
+        await self.sync_tree()
+
+    async def sync_tree(self):
+        # syncing is a rate limited global call, so it only runs when the commands changed
+        schema = json.dumps([command.to_dict(self.tree) for command in self.tree.get_commands()], sort_keys=True)
+        digest = hashlib.sha256(schema.encode()).hexdigest()
+        if os.path.exists('data/tree.hash'):
+            with open('data/tree.hash') as hash_file:
+                if hash_file.read() == digest: return
+        await self.tree.sync()
+        with open('data/tree.hash', 'w') as hash_file:
+            hash_file.write(digest)
+        print('Command Tree Synced.')
+
+    async def close(self):
+        await super().close()
+        await self.session.close()
 
     async def on_ready(self):
-        print(f'{bot.user.name} Initialized.')
+        print(f'{self.user.name} Initialized ({time.perf_counter() - self.started:.1f}s, {memory.describe()}).')
 
-bot = DiscordBot()
-with open('data/token.txt') as token:
-    bot.run(token.readline())
+if __name__ == '__main__':
+    bot = DiscordBot()
+    with open('data/token.txt') as token:
+        bot.run(token.readline())